@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# Times builds against synthetic GameData and asset trees so that performance regressions
+# can be measured without the game files. The project assets are copied into the synthetic tree
+# so that the ShrineRush generators run on the real event flows.
+import argparse
+import json
+import os
+from pathlib import Path
+import random
+import shutil
+import tempfile
+import typing
+
+import byml
+
+from build import ShrineRushBuilder, ShrineRushState
+from builder import Builder, assets_dir, build_targets
+from compression import CompressionCache
+from profiling import BuildProfiler
+
+def _make_flag(name: str, init_value: int) -> dict:
+    return {
+        'DataName': name,
+        'DeleteRev': byml.Int(-1),
+        'HashValue': byml.Int(0),
+        'InitValue': byml.Int(init_value),
+        'IsEventAssociated': False,
+        'IsOneTrigger': True,
+        'IsProgramReadable': True,
+        'IsProgramWritable': True,
+        'IsSave': True,
+        'MaxValue': byml.Int(1),
+        'MinValue': byml.Int(0),
+        'ResetType': byml.Int(0),
+    }
+
+def write_synthetic_gamedata(gamedata_dir: Path, num_files: int, flags_per_file: int, rng: random.Random) -> None:
+    # Each file gets a mix of the flags the generators look up (shrine, enemy scaling) and filler flags.
+    gamedata_dir.mkdir(parents=True)
+    for i in range(num_files):
+        bool_flags = []
+        s32_flags = []
+        for j in range(flags_per_file):
+            dungeon = rng.randrange(136)
+            kind = rng.randrange(4)
+            if kind == 0:
+                bool_flags.append(_make_flag(f'Dungeon{dungeon:03d}_Bench{i}_{j}', rng.randrange(2)))
+            elif kind == 1:
+                bool_flags.append(_make_flag(f'CDungeon_Dungeon{dungeon:03d}_Bench{i}_{j}', 0))
+            elif kind == 2:
+                s32_flags.append(_make_flag(f'Defeated_Bench{i}_{j}_Num', 0))
+            else:
+                bool_flags.append(_make_flag(f'Bench{i}_{j}', 0))
+        with (gamedata_dir/f'bench_{i}.bgdata').open('wb') as f:
+            byml.Writer({'bool_data': bool_flags, 's32_data': s32_flags}, be=False, version=2).write(f) # type: ignore
+
+def _make_asset_data(size: int, rng: random.Random) -> bytes:
+    # Partly repetitive so that Yaz0 has something to do, like real game resources.
+    parts = []
+    for _ in range(size // 4096 + 1):
+        parts.append(rng.getrandbits(512 * 8).to_bytes(512, 'little') * 8)
+    return b''.join(parts)[:size]
+
+def write_synthetic_assets(dest_dir: Path, num_assets: int, asset_size: int, rng: random.Random) -> None:
+    # Assets are spread over the kinds of work the asset stage does:
+    # compressed copies, plain copies, BYML conversions and messages (which are fanned out to every language).
+    shutil.copytree(assets_dir, dest_dir, symlinks=True)
+    for i in range(num_assets):
+        kind = i % 4
+        if kind == 0:
+            path = dest_dir/'Pack'/'Bench.pack'/'Actor'/f'Bench{i:05d}.sbfres'
+        elif kind == 1:
+            path = dest_dir/'Bench'/f'Bench{i:05d}.bin'
+        elif kind == 2:
+            path = dest_dir/'Bench'/f'Bench{i:05d}.sbyml.yml'
+        else:
+            path = dest_dir/'Pack'/'Bootup_EUen.pack'/'Message'/'Msg_EUen.product.ssarc'/'Bench'/f'Bench{i:05d}.msbt'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if kind == 2:
+            entries = [{'Name': f'Bench{i:05d}_{j}', 'Value': rng.randrange(1 << 16)} for j in range(asset_size // 64)]
+            path.write_text(json.dumps({'Entries': entries})) # JSON is valid YAML and much faster to emit.
+        else:
+            path.write_bytes(_make_asset_data(asset_size, rng))
+
+def run_build(name: str, targets: typing.List[str], gamedata_dir: Path, source_assets_dir: Path, build_dir: Path,
+              cache_dir: typing.Optional[Path], jobs: typing.Optional[int], incremental: bool,
+              cprofile_dir: typing.Optional[Path]) -> dict:
+    print(f'=== {name} ===')
+    compression_cache = CompressionCache(cache_dir/'yaz0', max_size=2048 * 1024 * 1024) if cache_dir else None
+    shared = ShrineRushState()
+    shared.profiler = BuildProfiler(cprofile_dir/name if cprofile_dir else None)
+    builders: typing.List[Builder] = []
+    for target in targets:
+        builders.append(ShrineRushBuilder(wiiu=target == 'wiiu', gamedata_dir=gamedata_dir,
+                                          build_assets_dir=build_dir/f'assets_{target}', jobs=jobs,
+                                          compression_cache=compression_cache, incremental=incremental,
+                                          cache_dir=cache_dir, shared=shared, source_assets_dir=source_assets_dir))
+    build_targets(builders)
+    result = shared.profiler.to_dict()
+    result['name'] = name
+    return result
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark the builder against synthetic data')
+    parser.add_argument('-t', '--target', choices=['wiiu', 'switch', 'all'], default='all', help='Target platform')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of parallel jobs (default: number of CPUs)')
+    parser.add_argument('--bgdata-files', type=int, default=8, help='Number of synthetic bgdata files')
+    parser.add_argument('--flags', type=int, default=5000, help='Number of flags per bgdata file')
+    parser.add_argument('--assets', type=int, default=400, help='Number of synthetic assets')
+    parser.add_argument('--asset-size', type=int, default=64 * 1024, help='Size of each synthetic asset in bytes')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the synthetic data')
+    parser.add_argument('--cache', action='store_true', help='Enable the compression and GameData caches')
+    parser.add_argument('--work-dir', help='Directory for the synthetic data and build trees (default: a temporary directory)')
+    parser.add_argument('--cprofile-dir', help='Write a cProfile capture of each build stage to this directory')
+    parser.add_argument('-o', '--output', help='Write the results to this JSON file')
+    args = parser.parse_args()
+    targets = ['wiiu', 'switch'] if args.target == 'all' else [args.target]
+    cprofile_dir = Path(args.cprofile_dir) if args.cprofile_dir else None
+
+    with tempfile.TemporaryDirectory(prefix='shrine_rush_bench_') as tmp_dir:
+        work_dir = Path(args.work_dir) if args.work_dir else Path(tmp_dir)
+        if work_dir.exists() and any(work_dir.iterdir()):
+            raise ValueError(f'{work_dir} is not empty')
+        rng = random.Random(args.seed)
+        gamedata_dir = work_dir/'gamedata'
+        source_assets_dir = work_dir/'assets'
+        build_dir = work_dir/'build'
+        cache_dir = work_dir/'cache' if args.cache else None
+        print('generating synthetic data')
+        write_synthetic_gamedata(gamedata_dir, args.bgdata_files, args.flags, rng)
+        write_synthetic_assets(source_assets_dir, args.assets, args.asset_size, rng)
+
+        def run(name: str, incremental: bool) -> dict:
+            return run_build(name, targets, gamedata_dir, source_assets_dir, build_dir, cache_dir,
+                             args.jobs, incremental, cprofile_dir)
+
+        runs = [run('full', incremental=False)]
+        runs.append(run('incremental (no changes)', incremental=True))
+        touched = sorted((source_assets_dir/'Pack'/'Bench.pack'/'Actor').glob('*.sbfres'))[:1]
+        for path in touched:
+            path.write_bytes(_make_asset_data(args.asset_size, rng))
+        runs.append(run('incremental (one asset changed)', incremental=True))
+
+    config = {key: value for key, value in vars(args).items() if key not in ('output', 'work_dir', 'cprofile_dir')}
+    results = {'config': config, 'cpu_count': os.cpu_count(), 'runs': runs}
+    for result in runs:
+        print(f'{result["name"]}: {result["wall_time"]:.3f}s wall, {result["cpu_time"]:.3f}s cpu')
+        for stage in result['stages']:
+            print(f'  {stage["wall_time"]:8.3f}s  {stage["name"]}')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+
+if __name__ == '__main__':
+    main()
@@ -1,36 +1,144 @@
 #!/usr/bin/env python3
 import argparse
-import contextlib
-import csv
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import os
 from pathlib import Path
+import re
 import signal
+import sys
+import traceback
 import typing
 import yaml
 
-from builder import Builder, root
+from builder import Builder, SharedState, assets_dir, build_targets, root
+from compression import CompressionCache, link_or_copy_file
+from profiling import BuildProfiler
 import byml
 import evfl
 from evfl.entry_point import EntryPoint
 from evfl.common import IdGenerator, make_index, make_rindex
-from generate_shrine_list import Shrine
+from generate_shrine_list import Shrine, load_route, routes_dir
+from packaging import create_archive, remove_archives
+from verify import FileDiff, diff_trees, report_diff, save_diff
+from watch import FileWatcher
 
 class FlagToReset(typing.NamedTuple):
     name: str
     val: typing.Union[bool, int, float]
+    # Shrine the flag belongs to, for flags that only need to be reset when entering that shrine.
+    dungeon: typing.Optional[int] = None
+
+def _get_data_type(val: typing.Any) -> typing.Optional[str]:
+    # GameData type of the flag that the reset events write val to.
+    if isinstance(val, bool):
+        return 'bool'
+    if isinstance(val, int):
+        return 's32'
+    if isinstance(val, float):
+        return 'f32'
+    return None
+
+def _get_map_dungeon_number(map_name: str) -> typing.Optional[int]:
+    # e.g. 0 for the map Dungeon000. None for maps that are not shrines.
+    if map_name.startswith('Dungeon') and map_name[7:].isdigit():
+        return int(map_name[7:])
+    return None
+
+# Index in shrine_rush_order.csv of the current shrine. Only used with the 'tree' dispatch for ShrineRush<Next>.
+SHRINE_INDEX_FLAG = 'ShrineRush_Index'
+
+# ShrineRush_Mode of the first extra route (0-3 are the built-in routes).
+FIRST_ROUTE_MODE = 4
+
+# Event indices are u16 and 0xffff means "no event", so an event flow can hold at most this many events.
+MAX_EVENTS = 0xffff
+
+def _get_route_entry_name(route_name: str) -> str:
+    return 'Next_Route_' + re.sub(r'\W', '_', route_name)
+
+def _get_reset_flag_entry_name(dungeon: int) -> str:
+    return 'ResetFlag_Dungeon%03d' % dungeon
+
+class ShrineRushState(SharedState):
+    def __init__(self) -> None:
+        super().__init__()
+        self.flags_to_reset: typing.List[FlagToReset] = []
+        self.edited_bgdata_names: typing.List[str] = []
 
 class ShrineRushBuilder(Builder):
-    def __init__(self, **kwargs) -> None:
+    shared: ShrineRushState
+
+    # per_shrine_reset: reset shrine flags when entering each shrine instead of resetting
+    # the flags of every shrine when entering Shrine Rush.
+    # next_dispatch: how ShrineRush<Next> finds the current shrine:
+    #  - 'chain': one CheckCurrentMap query per shrine until the current map matches
+    #  - 'tree': binary search over ShrineRush_Index, which is set whenever a shrine is entered
+    def __init__(self, per_shrine_reset: bool = False, next_dispatch: str = 'chain', **kwargs) -> None:
+        kwargs.setdefault('shared', ShrineRushState())
+        self.per_shrine_reset = per_shrine_reset
+        self.next_dispatch = next_dispatch
         super().__init__(**kwargs)
-        self._bfevfl_path = self.build_assets_dir/'Event'/'ShrineRush.sbeventpack'/'EventFlow'/'ShrineRush.bfevfl'
+        self._bfevfl_path = self.assets_dir/'Event'/'ShrineRush.sbeventpack'/'EventFlow'/'ShrineRush.bfevfl'
         self._evfl_id_generator = IdGenerator()
-        self.flags_to_reset = self.generate_flags_to_reset()
+        # Number of extra routes and of the events that were generated for them, for reporting the route limit.
+        self._num_routes = 0
+        self._num_route_events = 0
+
+    @property
+    def flags_to_reset(self) -> typing.List[FlagToReset]:
+        return self.shared.flags_to_reset
 
     def _build_project(self) -> None:
-        self._generate_event_next()
-        self._generate_event_enter_reset_flag()
-        self._generate_event_enter_edit_inventory()
-        self._generate_gamedata_config()
+        with self.profiler.stage('[ShrineRush] generate flags to reset'):
+            self.shared.flags_to_reset = self.generate_flags_to_reset()
+        with self.profiler.stage('[ShrineRush] generate ShrineRush<Next>'):
+            self._generate_event_next()
+        with self.profiler.stage('[ShrineRush] generate ShrineRush<Enter_ResetFlag>'):
+            self._generate_event_enter_reset_flag()
+        with self.profiler.stage('[ShrineRush] generate ShrineRush<Enter_EditInventory>'):
+            self._generate_event_enter_edit_inventory()
+        with self.profiler.stage('[ShrineRush] generate GameData configuration'):
+            self._generate_gamedata_config()
+        self._check_event_count()
+
+    def _check_event_count(self) -> None:
+        # Writing an event flow with too many events fails with an unhelpful struct.error.
+        num_events = len(self.event_flows.get(self._bfevfl_path).flowchart.events)
+        if num_events <= MAX_EVENTS:
+            return
+        message = f'ShrineRush.bfevfl would have {num_events} events, but an event flow can only have {MAX_EVENTS}'
+        if self._num_routes:
+            events_per_route = self._num_route_events / self._num_routes
+            max_routes = max(0, int((MAX_EVENTS - (num_events - self._num_route_events)) // events_per_route))
+            message += f': there are {self._num_routes} routes in routes/, but only about {max_routes} routes ' \
+                       f'of this length fit'
+        raise ValueError(message)
+
+    def _write_project_outputs(self) -> None:
+        self._write_gamedata_config()
+
+    def _get_project_inputs(self) -> typing.Dict[str, Path]:
+        inputs = super()._get_project_inputs()
+        inputs['shrine_rush_order.csv'] = root/'shrine_rush_order.csv'
+        inputs['inventory_items.yml'] = root/'inventory_items.yml'
+        for path in routes_dir.glob('*.csv'):
+            inputs[f'routes/{path.name}'] = path
+        return inputs
+
+    def _get_project_options(self) -> typing.Dict[str, str]:
+        return {'reset_mode': 'per-shrine' if self.per_shrine_reset else 'all', 'next_dispatch': self.next_dispatch}
+
+    def _get_project_assets(self) -> typing.List[Path]:
+        return [self._bfevfl_path]
+
+    def _load_shrine_order(self) -> typing.List[Shrine]:
+        return load_route(root/'shrine_rush_order.csv')
+
+    def _load_routes(self) -> typing.List[typing.Tuple[str, typing.List[Shrine]]]:
+        # Extra routes (generated by generate_shrine_list.py --name or written by hand).
+        # They are selected with ShrineRush_Mode values starting from FIRST_ROUTE_MODE, in file name order.
+        return [(path.stem, load_route(path)) for path in sorted(routes_dir.glob('*.csv'))]
 
     def generate_flags_to_reset(self) -> typing.List[FlagToReset]:
         l = []
@@ -46,142 +154,251 @@ class ShrineRushBuilder(Builder):
         l.append(FlagToReset(name='MaxHartValue', val=52))
         l.append(FlagToReset(name='StaminaCurrentMax', val=3000.0))
         l.append(FlagToReset(name='StaminaMax', val=3000.0))
+        if self.next_dispatch == 'tree':
+            # ShrineRush<Enter> warps to the first shrine.
+            l.append(FlagToReset(name=SHRINE_INDEX_FLAG, val=0))
 
-        for flag in self.gamedata_flags['bool']:
-            name: str = flag['DataName']
-            if name.startswith('CDungeon_'):
-                l.append(FlagToReset(name=name, val=False))
+        for flag in self.gamedata.find_by_prefix('bool', 'CDungeon_'):
+            l.append(FlagToReset(name=flag['DataName'], val=False))
 
-        for flag in self.gamedata_flags['s32']:
-            name = flag['DataName']
-            if name.startswith('Defeated_'):
-                l.append(FlagToReset(name=name, val=0))
+        for flag in self.gamedata.find_by_prefix('s32', 'Defeated_'):
+            l.append(FlagToReset(name=flag['DataName'], val=0))
 
         for i in range(136):
             l.append(FlagToReset(name='Open_Dungeon%03d' % i, val=True))
-            l.append(FlagToReset(name='Enter_Dungeon%03d' % i, val=False))
-            l.append(FlagToReset(name='Clear_Dungeon%03d' % i, val=False))
-            for data_type in self.gamedata_flags:
-                for flag in self.gamedata_flags[data_type]:
-                    name = flag['DataName']
-                    if name.startswith('Dungeon%03d' % i):
-                        initial_val = flag['InitValue']
-                        if data_type == 'bool':
-                            initial_val = initial_val != 0
-                        l.append(FlagToReset(name=name, val=initial_val))
-
-        return l
-
-    @contextlib.contextmanager
-    def _get_main_event_flow(self) -> typing.Iterator[evfl.EventFlow]:
-        event_flow = evfl.EventFlow()
-        with self._bfevfl_path.open('rb') as f:
-            event_flow.read(f.read())
-        try:
-            yield event_flow
-        finally:
-            with self._bfevfl_path.open('wb') as f:
-                event_flow.write(f) # type: ignore
+            l.append(FlagToReset(name='Enter_Dungeon%03d' % i, val=False, dungeon=i))
+            l.append(FlagToReset(name='Clear_Dungeon%03d' % i, val=False, dungeon=i))
+            for data_type, flag in self.gamedata.find_dungeon_flags(i):
+                initial_val = flag['InitValue']
+                if data_type == 'bool':
+                    initial_val = initial_val != 0
+                l.append(FlagToReset(name=flag['DataName'], val=initial_val, dungeon=i))
+
+        # A flag can be defined in several bgdata files. Only reset it once (with the last value).
+        flags: typing.Dict[str, FlagToReset] = dict()
+        for flag_to_reset in l:
+            flags[flag_to_reset.name] = flag_to_reset
+        return list(flags.values())
 
     def _generate_event_next(self) -> None:
         print('[ShrineRush] generating ShrineRush<Next>')
-        with (root/'shrine_rush_order.csv').open('r') as f:
-            shrines = [Shrine(row['map_name'], row['title'], row['sub']) for row in csv.DictReader(f)]
+        shrines = self._load_shrine_order()
+        reset_dungeons = set(flag.dungeon for flag in self.flags_to_reset if flag.dungeon is not None)
 
-        with self._get_main_event_flow() as event_flow:
+        with self.event_flows.edit(self._bfevfl_path) as event_flow:
             flowchart = event_flow.flowchart
             assert flowchart
 
             EventSystemActor = flowchart.find_actor(evfl.ActorIdentifier('EventSystemActor'))
             ChangeScene = EventSystemActor.find_action('Demo_ChangeScene')
+            SetGameDataInt = EventSystemActor.find_action('Demo_SetGameDataInt')
             CheckCurrentMap = EventSystemActor.find_query('CheckCurrentMap')
-            FlagOFF = EventSystemActor.find_action('Demo_FlagOFF')
+            CheckGameDataInt = EventSystemActor.find_query('CheckGameDataInt')
 
-            def generate_chain(entry_name: str, shrines: typing.List[Shrine]):
-                # generate events
+            def add_event(data: evfl.event.BaseEvent) -> evfl.Event:
+                assert flowchart
+                evt = evfl.Event()
+                evt.data = data
+                flowchart.add_event(evt, self._evfl_id_generator)
+                return evt
+
+            exit_data = evfl.SubFlowEvent()
+            exit_data.entry_point_name = 'Exit'
+            exit_evt = add_event(exit_data)
+
+            # Warps are shared by all Next_* variants.
+            warp_events: typing.Dict[int, evfl.Event] = dict()
+            def get_warp_event(i: int) -> evfl.Event:
+                # Warp to shrines[i]:
+                # [ResetFlag_DungeonNNN] -> [set ShrineRush_Index] -> Next_BeforeSceneChange -> ChangeScene
+                evt = warp_events.get(i)
+                if evt:
+                    return evt
+                scene_data = evfl.ActionEvent()
+                scene_data.actor = make_rindex(EventSystemActor)
+                scene_data.actor_action = make_rindex(ChangeScene)
+                scene_data.params = evfl.Container()
+                scene_data.params.data['IsWaitFinish'] = True
+                scene_data.params.data['WarpDestMapName'] = 'CDungeon/' + shrines[i].map_name
+                scene_data.params.data['WarpDestPosName'] = 'Entrance_1'
+                scene_data.params.data['FadeType'] = 2
+                scene_data.params.data['StartType'] = 0
+                scene_data.params.data['EvflName'] = 'Demo008_2'
+                scene_data.params.data['EntryPointName'] = 'Demo008_2'
+                # Clear the IsInside_Dungeon flag to ensure the dungeon entrance demo works correctly
+                # (otherwise the entrance elevator actor gets signalled too early).
+                before_data = evfl.SubFlowEvent()
+                before_data.entry_point_name = 'Next_BeforeSceneChange'
+                before_data.nxt = make_index(add_event(scene_data))
+                evt = add_event(before_data)
+
+                if self.next_dispatch == 'tree':
+                    index_data = evfl.ActionEvent()
+                    index_data.actor = make_rindex(EventSystemActor)
+                    index_data.actor_action = make_rindex(SetGameDataInt)
+                    index_data.params = evfl.Container()
+                    index_data.params.data['IsWaitFinish'] = True
+                    index_data.params.data['GameDataIntName'] = SHRINE_INDEX_FLAG
+                    index_data.params.data['Value'] = i
+                    index_data.nxt = make_index(evt)
+                    evt = add_event(index_data)
+
+                dungeon = _get_map_dungeon_number(shrines[i].map_name)
+                if self.per_shrine_reset and dungeon in reset_dungeons:
+                    assert dungeon is not None
+                    # Reset the flags of the next shrine before warping to it.
+                    reset_data = evfl.SubFlowEvent()
+                    reset_data.entry_point_name = _get_reset_flag_entry_name(dungeon)
+                    reset_data.nxt = make_index(evt)
+                    evt = add_event(reset_data)
+
+                warp_events[i] = evt
+                return evt
+
+            def get_next_event(indices: typing.List[int], k: int) -> evfl.Event:
+                # Event for leaving shrines[indices[k]].
+                if k == len(indices) - 1:
+                    return exit_evt
+                return get_warp_event(indices[k + 1])
+
+            def generate_chain(indices: typing.List[int]) -> evfl.Event:
                 # CheckCurrentMap (current shrine)
                 #   -> 1: Warp to next shrine
                 #   -> 0: CheckCurrentMap (next shrine) etc.
-                assert flowchart
+                # The last check always leaves Shrine Rush.
                 first_event = None
                 previous_switch_evt = None
-                for i in range(len(shrines)):
-                    shrine = shrines[i]
-                    is_last = i == len(shrines) - 1
-
-                    next_evt = evfl.Event()
-                    if is_last:
-                        next_evt.data = evfl.SubFlowEvent()
-                        next_evt.data.entry_point_name = 'Exit'
-                    else:
-                        # Clear the IsInside_Dungeon flag to ensure the dungeon entrance demo works correctly
-                        # (otherwise the entrance elevator actor gets signalled too early).
-                        next_evt.data = evfl.SubFlowEvent()
-                        next_evt.data.entry_point_name = 'Next_BeforeSceneChange'
-                        scene_evt = evfl.Event()
-                        flowchart.add_event(scene_evt, self._evfl_id_generator)
-                        next_evt.data.nxt = make_index(scene_evt)
-                        scene_evt.data = evfl.ActionEvent()
-                        scene_evt.data.actor = make_rindex(EventSystemActor)
-                        scene_evt.data.actor_action = make_rindex(ChangeScene)
-                        scene_evt.data.params = evfl.Container()
-                        scene_evt.data.params.data['IsWaitFinish'] = True
-                        scene_evt.data.params.data['WarpDestMapName'] = 'CDungeon/' + shrines[i+1].map_name
-                        scene_evt.data.params.data['WarpDestPosName'] = 'Entrance_1'
-                        scene_evt.data.params.data['FadeType'] = 2
-                        scene_evt.data.params.data['StartType'] = 0
-                        scene_evt.data.params.data['EvflName'] = 'Demo008_2'
-                        scene_evt.data.params.data['EntryPointName'] = 'Demo008_2'
-
-                    e = evfl.Event()
-                    e.data = evfl.SwitchEvent()
-                    e.data.actor = make_rindex(EventSystemActor)
-                    e.data.actor_query = make_rindex(CheckCurrentMap)
-                    e.data.params = evfl.Container()
-                    e.data.params.data['MapName'] = shrine.map_name
-                    e.data.cases[1] = make_rindex(next_evt)
-                    if is_last:
-                        e.data.cases[0] = make_rindex(next_evt)
-                    flowchart.add_event(e, self._evfl_id_generator)
-                    flowchart.add_event(next_evt, self._evfl_id_generator)
+                for k, i in enumerate(indices):
+                    next_evt = get_next_event(indices, k)
+                    data = evfl.SwitchEvent()
+                    data.actor = make_rindex(EventSystemActor)
+                    data.actor_query = make_rindex(CheckCurrentMap)
+                    data.params = evfl.Container()
+                    data.params.data['MapName'] = shrines[i].map_name
+                    data.cases[1] = make_rindex(next_evt)
+                    if k == len(indices) - 1:
+                        data.cases[0] = make_rindex(next_evt)
+                    e = add_event(data)
                     if previous_switch_evt:
                         previous_switch_evt.data.cases[0] = make_index(e)
                     previous_switch_evt = e
-
-                    if i == 0:
+                    if first_event is None:
                         first_event = e
-
-                # add the entry point
-                entry_point = EntryPoint(entry_name)
                 assert first_event
+                return first_event
+
+            def generate_search_tree(flag_name: str, keys: typing.List[int], leaves: typing.List[evfl.Event],
+                                     lo: int, hi: int) -> evfl.Event:
+                # Binary search over the value of an s32 flag. keys must be sorted;
+                # leaves[k] is used for values in [keys[k], keys[k+1]).
+                # CheckGameDataInt (flag >= key of the middle leaf)
+                #   -> 1: upper half
+                #   -> 0: lower half
+                # This needs ceil(log2(n)) queries instead of up to n queries for a chain.
+                if hi - lo == 1:
+                    return leaves[lo]
+                mid = (lo + hi) // 2
+                data = evfl.SwitchEvent()
+                data.actor = make_rindex(EventSystemActor)
+                data.actor_query = make_rindex(CheckGameDataInt)
+                data.params = evfl.Container()
+                data.params.data['GameDataIntName'] = flag_name
+                data.params.data['Operator'] = 'GreaterThanOrEqualTo'
+                data.params.data['Value'] = keys[mid]
+                data.cases[1] = make_rindex(generate_search_tree(flag_name, keys, leaves, mid, hi))
+                data.cases[0] = make_rindex(generate_search_tree(flag_name, keys, leaves, lo, mid))
+                return add_event(data)
+
+            def generate_tree(indices: typing.List[int]) -> evfl.Event:
+                # Search over the index of the current shrine in shrine_rush_order.csv.
+                order = sorted(range(len(indices)), key=lambda k: indices[k])
+                return generate_search_tree(SHRINE_INDEX_FLAG, [indices[k] for k in order],
+                                            [get_next_event(indices, k) for k in order], 0, len(indices))
+
+            def generate_entry(entry_name: str, indices: typing.List[int]) -> None:
+                assert flowchart
+                if self.next_dispatch == 'tree':
+                    first_event = generate_tree(indices)
+                else:
+                    first_event = generate_chain(indices)
+                entry_point = EntryPoint(entry_name)
                 entry_point.main_event = make_rindex(first_event)
                 flowchart.entry_points.append(entry_point)
 
-            generate_chain('Next_All', shrines)
-            generate_chain('Next_WithoutBlessings', [s for s in shrines if not s.sub.endswith(' Blessing')])
-            generate_chain('Next_WithoutTestsOfStrength', [s for s in shrines if not s.sub.endswith(' Test of Strength')])
-            generate_chain('Next_WithoutBlessingsOrTestsOfStrength', [s for s in shrines if not s.sub.endswith(' Test of Strength') and not s.sub.endswith(' Blessing')])
+            all_indices = list(range(len(shrines)))
+            generate_entry('Next_All', all_indices)
+            generate_entry('Next_WithoutBlessings', [i for i in all_indices if not shrines[i].sub.endswith(' Blessing')])
+            generate_entry('Next_WithoutTestsOfStrength', [i for i in all_indices if not shrines[i].sub.endswith(' Test of Strength')])
+            generate_entry('Next_WithoutBlessingsOrTestsOfStrength', [i for i in all_indices if not shrines[i].sub.endswith(' Test of Strength') and not shrines[i].sub.endswith(' Blessing')])
+
+            # Extra routes share the warps of the built-in ones and are identified by the index of their shrines
+            # in shrine_rush_order.csv, so every shrine they use must be in it.
+            self._num_routes = 0
+            self._num_route_events = 0
+            routes = self._load_routes()
+            if not routes:
+                return
+            num_events_before_routes = len(flowchart.events)
+            shrine_indices = {shrine.map_name: i for i, shrine in enumerate(shrines)}
+            route_events: typing.List[evfl.Event] = []
+            route_names: typing.Dict[str, str] = dict()
+            for route_name, route in routes:
+                if not route:
+                    raise ValueError(f'route {route_name}: has no shrines')
+                entry_name = _get_route_entry_name(route_name)
+                if entry_name in route_names:
+                    raise ValueError(f'route {route_name}: entry point {entry_name} is already used by route {route_names[entry_name]}')
+                route_names[entry_name] = route_name
+                for shrine in route:
+                    if shrine.map_name not in shrine_indices:
+                        raise ValueError(f'route {route_name}: {shrine.map_name} is not in shrine_rush_order.csv')
+                indices = [shrine_indices[shrine.map_name] for shrine in route]
+                if len(set(indices)) != len(indices):
+                    raise ValueError(f'route {route_name}: shrines can only appear once')
+                # ShrineRush<Enter> always warps to the first shrine of the main order.
+                if indices[0] != 0:
+                    raise ValueError(f'route {route_name}: must start with {shrines[0].map_name}')
+                generate_entry(entry_name, indices)
+                sub_flow_data = evfl.SubFlowEvent()
+                sub_flow_data.entry_point_name = entry_name
+                route_events.append(add_event(sub_flow_data))
+                print(f'[ShrineRush] route {route_name}: ShrineRush_Mode {FIRST_ROUTE_MODE + len(route_events) - 1}')
+
+            # Hook the routes into ShrineRush<Next> after the check for the last built-in mode.
+            last_mode_check = None
+            for evt in flowchart.events:
+                if isinstance(evt.data, evfl.SwitchEvent) and evt.data.actor_query.v.v == 'CheckGameDataInt' \
+                        and evt.data.params and evt.data.params.data.get('GameDataIntName') == 'ShrineRush_Mode' \
+                        and evt.data.params.data.get('Value') == FIRST_ROUTE_MODE - 1:
+                    last_mode_check = evt
+            if last_mode_check is None or 0 in last_mode_check.data.cases:
+                raise ValueError(f'ShrineRush<Next> has no free case for ShrineRush_Mode >= {FIRST_ROUTE_MODE}')
+            modes = list(range(FIRST_ROUTE_MODE, FIRST_ROUTE_MODE + len(route_events)))
+            last_mode_check.data.cases[0] = make_rindex(
+                generate_search_tree('ShrineRush_Mode', modes, route_events, 0, len(route_events)))
+            self._num_routes = len(routes)
+            self._num_route_events = len(flowchart.events) - num_events_before_routes
 
     def _generate_gamedata_config(self) -> None:
         print('[ShrineRush] generating GameData configuration')
-        flags_to_reset_set: typing.Set[str] = set(f.name for f in self.flags_to_reset)
+        edited_bgdata_names: typing.Set[str] = set()
+        for flag_to_reset in self.flags_to_reset:
+            for entry in self.gamedata.find(flag_to_reset.name, _get_data_type(flag_to_reset.val)):
+                entry.flag['IsOneTrigger'] = False
+                edited_bgdata_names.add(entry.bgdata_name)
+        self.shared.edited_bgdata_names = sorted(edited_bgdata_names)
+
+    def _write_gamedata_config(self) -> None:
         gdt_dest_dir = self.build_assets_dir/'Pack'/'Bootup.pack'/'GameData'/'gamedata.ssarc'
-        for bgdata_name, bgdata in self.gamedata_bgdata.items():
-            is_edited = False
-            for data_type_key, flags in bgdata.items():
-                for flag in flags:
-                    if flag['DataName'] in flags_to_reset_set:
-                        flag['IsOneTrigger'] = False
-                        is_edited = True
-            if not is_edited:
-                continue
+        for bgdata_name in self.shared.edited_bgdata_names:
             with (gdt_dest_dir/(bgdata_name)).open('wb') as f:
-                writer = byml.Writer(bgdata, be=self.wiiu, version=2)
+                writer = byml.Writer(self.gamedata.get_bgdata(bgdata_name), be=self.wiiu, version=2)
                 writer.write(f) # type: ignore
+            self._add_generated_file(gdt_dest_dir/bgdata_name)
 
     def _generate_event_enter_reset_flag(self) -> None:
         print('[ShrineRush] generating ShrineRush<Enter_ResetFlag>')
-        with self._get_main_event_flow() as event_flow:
+        with self.event_flows.edit(self._bfevfl_path) as event_flow:
             flowchart = event_flow.flowchart
             assert flowchart
 
@@ -191,8 +408,7 @@ class ShrineRushBuilder(Builder):
             SetGameDataInt = EventSystemActor.find_action('Demo_SetGameDataInt')
             SetGameDataFloat = EventSystemActor.find_action('Demo_SetGameDataFloat')
 
-            events: typing.List[evfl.Event] = []
-            for flag in self.flags_to_reset:
+            def make_reset_event(flag: FlagToReset) -> evfl.Event:
                 evt = evfl.Event()
                 evt.data = evfl.ActionEvent()
                 evt.data.actor = make_rindex(EventSystemActor)
@@ -211,13 +427,30 @@ class ShrineRushBuilder(Builder):
                     evt.data.params.data['IsWaitFinish'] = True
                     evt.data.params.data['GameDataFloatName'] = flag.name
                     evt.data.params.data['Value'] = flag.val
-                events.append(evt)
+                return evt
 
-            flowchart.botw_add_action_chain_and_entry('Enter_ResetFlag', events, self._evfl_id_generator)
+            if not self.per_shrine_reset:
+                events = [make_reset_event(flag) for flag in self.flags_to_reset]
+                flowchart.botw_add_action_chain_and_entry('Enter_ResetFlag', events, self._evfl_id_generator)
+                return
+
+            # Shrine flags are reset by ShrineRush<Next> right before warping to each shrine.
+            # The first shrine is entered straight from ShrineRush<Enter>, so its flags are reset here.
+            shrine_flags: typing.DefaultDict[int, typing.List[FlagToReset]] = defaultdict(list)
+            for flag in self.flags_to_reset:
+                if flag.dungeon is not None:
+                    shrine_flags[flag.dungeon].append(flag)
+            first_dungeon = _get_map_dungeon_number(self._load_shrine_order()[0].map_name)
+            enter_flags = [flag for flag in self.flags_to_reset if flag.dungeon is None or flag.dungeon == first_dungeon]
+            flowchart.botw_add_action_chain_and_entry('Enter_ResetFlag', [make_reset_event(flag) for flag in enter_flags],
+                                                      self._evfl_id_generator)
+            for dungeon, flags in sorted(shrine_flags.items()):
+                flowchart.botw_add_action_chain_and_entry(_get_reset_flag_entry_name(dungeon),
+                                                          [make_reset_event(flag) for flag in flags], self._evfl_id_generator)
 
     def _generate_event_enter_edit_inventory(self) -> None:
         print('[ShrineRush] generating ShrineRush<Enter_EditInventory>')
-        with self._get_main_event_flow() as event_flow:
+        with self.event_flows.edit(self._bfevfl_path) as event_flow:
             flowchart = event_flow.flowchart
             assert flowchart
 
@@ -254,21 +487,160 @@ class ShrineRushBuilder(Builder):
 
             flowchart.botw_add_action_chain_and_entry('Enter_EditInventory', events, self._evfl_id_generator)
 
+def signal_patcher() -> None:
+    patcher_pid = os.environ.get('PATCHER_PID', None)
+    if patcher_pid is not None:
+        os.kill(int(patcher_pid), signal.SIGUSR1)
+
+def package_main(argv: typing.List[str]) -> None:
+    # Packages the final patches (build/patch_{target}, made by botw-patcher) into release archives.
+    parser = argparse.ArgumentParser(prog='build.py package')
+    parser.add_argument('-t', '--target', choices=['wiiu', 'switch', 'all'], help='Target platform', required=True)
+    parser.add_argument('--version', help='Release version', required=True)
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of compression threads (default: number of CPUs)')
+    args = parser.parse_args(argv)
+    targets = ['wiiu', 'switch'] if args.target == 'all' else [args.target]
+    build_dir = root/'build'
+    jobs = args.jobs or os.cpu_count() or 1
+
+    def package(target: str) -> None:
+        patch_dir = build_dir/f'patch_{target}'
+        if target == 'wiiu':
+            # The Wii U version has a separate USen message pack, which is identical to the EUen one.
+            link_or_copy_file(patch_dir/'Pack'/'Bootup_EUen.pack', patch_dir/'Pack'/'Bootup_USen.pack')
+        archive_path = build_dir/f'botw_shrine_rush_{args.version}_{target}.7z'
+        if not create_archive(patch_dir, archive_path, max(1, jobs // len(targets))):
+            print(f'{archive_path.name} is up to date')
+        remove_archives(build_dir, f'botw_shrine_rush_*_{target}.7z', archive_path)
+
+    # Both archives are compressed at the same time; each 7z process gets its share of the threads.
+    with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+        for _ in executor.map(package, targets):
+            pass
+
+def _add_diff_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of parallel jobs (default: number of CPUs)')
+    parser.add_argument('--max-differences', type=int, default=20, help='Maximum number of differences to show per file')
+    parser.add_argument('-o', '--output', help='Write the changed, added, removed and equivalent files to this JSON file')
+
+def _finish_diff(diffs: typing.List[FileDiff], output: typing.Optional[str]) -> None:
+    report_diff(diffs)
+    if output:
+        save_diff(diffs, Path(output))
+    # Files that only differ in serialization do not count as changes.
+    if any(d.status != 'equivalent' for d in diffs):
+        sys.exit(1)
+
+def diff_main(argv: typing.List[str]) -> None:
+    # Compares two build trees. Exits with status 1 if they differ.
+    parser = argparse.ArgumentParser(prog='build.py diff')
+    parser.add_argument('old', help='Previous build tree (e.g. a copy of build/assets_switch)')
+    parser.add_argument('new', help='New build tree')
+    _add_diff_arguments(parser)
+    args = parser.parse_args(argv)
+    for tree in (args.old, args.new):
+        if not Path(tree).is_dir():
+            parser.error(f'{tree} is not a directory')
+    jobs = args.jobs or os.cpu_count() or 1
+    _finish_diff(diff_trees(Path(args.old), Path(args.new), jobs, args.max_differences), args.output)
+
+def verify_main(argv: typing.List[str]) -> None:
+    # Compares the build trees in build/ against a previous build. Exits with status 1 if they differ.
+    parser = argparse.ArgumentParser(prog='build.py verify')
+    parser.add_argument('-t', '--target', choices=['wiiu', 'switch', 'all'], help='Target platform', required=True)
+    parser.add_argument('--baseline', help='Directory that contains the previous build trees (e.g. a copy of build/)', required=True)
+    _add_diff_arguments(parser)
+    args = parser.parse_args(argv)
+    targets = ['wiiu', 'switch'] if args.target == 'all' else [args.target]
+    # Without this check, a wrong --baseline would report every file as added.
+    for target in targets:
+        for tree in (Path(args.baseline)/f'assets_{target}', root/'build'/f'assets_{target}'):
+            if not tree.is_dir():
+                parser.error(f'{tree} does not exist (was {target} built?)')
+    jobs = args.jobs or os.cpu_count() or 1
+    diffs: typing.List[FileDiff] = []
+    for target in targets:
+        name = f'assets_{target}'
+        for d in diff_trees(Path(args.baseline)/name, root/'build'/name, jobs, args.max_differences):
+            diffs.append(d._replace(rel=f'{name}/{d.rel}'))
+    _finish_diff(diffs, args.output)
+
+COMMANDS = {
+    'package': package_main,
+    'diff': diff_main,
+    'verify': verify_main,
+}
+
 def main() -> None:
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        COMMANDS[sys.argv[1]](sys.argv[2:])
+        return
+
     parser = argparse.ArgumentParser()
-    parser.add_argument('-t', '--target', choices=['wiiu', 'switch'], help='Target platform', required=True)
+    parser.add_argument('-t', '--target', choices=['wiiu', 'switch', 'all'], help='Target platform', required=True)
     parser.add_argument('--gamedata-dir', help='Path to GameData archive directory', required=True)
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of parallel jobs (default: number of CPUs)')
+    parser.add_argument('--cache-dir', default=str(root/'build'/'cache'), help='Path to the build cache directory')
+    parser.add_argument('--compression-cache-size', type=int, default=2048, help='Maximum size of the compression cache in MiB')
+    parser.add_argument('--no-compression-cache', action='store_true', help='Always recompress assets')
+    parser.add_argument('--incremental', action='store_true', help='Reuse an existing build directory and only rebuild what has changed')
+    parser.add_argument('--per-shrine-reset', action='store_true',
+                        help='Reset the flags of each shrine when entering it instead of resetting every shrine when entering Shrine Rush')
+    parser.add_argument('--next-dispatch', choices=['chain', 'tree'], default='chain',
+                        help='How ShrineRush<Next> finds the current shrine: CheckCurrentMap chains or a binary search over ShrineRush_Index')
+    parser.add_argument('--watch', action='store_true', help='Keep running and rebuild incrementally whenever an input changes (implies --incremental)')
+    parser.add_argument('--profile', help='Write per-stage timings, memory usage and file counts to this JSON file')
+    parser.add_argument('--cprofile-dir', help='Write a cProfile capture of each build stage to this directory')
     args = parser.parse_args()
-    target = args.target
-    wiiu = target == 'wiiu'
+    targets = ['wiiu', 'switch'] if args.target == 'all' else [args.target]
     gamedata_dir = Path(args.gamedata_dir)
-
-    builder = ShrineRushBuilder(wiiu=wiiu, gamedata_dir=gamedata_dir, build_assets_dir=root/'build'/f'assets_{target}')
-    builder.build()
-
-    patcher_pid = os.environ.get('PATCHER_PID', None)
-    if patcher_pid is not None:
-        os.kill(int(patcher_pid), signal.SIGUSR1)
+    cache_dir = Path(args.cache_dir)
+    compression_cache = None
+    if not args.no_compression_cache:
+        compression_cache = CompressionCache(cache_dir/'yaz0', max_size=args.compression_cache_size * 1024 * 1024)
+
+    # GameData flags, event flows and parsed YAML do not depend on the platform, so they are shared by all targets.
+    # Only the byte order of BYML files and the .nx resources differ.
+    shared = ShrineRushState()
+    shared.profiler = BuildProfiler(Path(args.cprofile_dir) if args.cprofile_dir else None)
+
+    def build() -> None:
+        builders: typing.List[Builder] = []
+        for target in targets:
+            builders.append(ShrineRushBuilder(wiiu=target == 'wiiu', gamedata_dir=gamedata_dir,
+                                              build_assets_dir=root/'build'/f'assets_{target}',
+                                              jobs=args.jobs, compression_cache=compression_cache,
+                                              incremental=args.incremental or args.watch, cache_dir=cache_dir, shared=shared,
+                                              per_shrine_reset=args.per_shrine_reset, next_dispatch=args.next_dispatch))
+        build_targets(builders)
+        if args.profile:
+            print('build profile:')
+            shared.profiler.report()
+            shared.profiler.save(Path(args.profile))
+        signal_patcher()
+
+    if not args.watch:
+        build()
+        return
+
+    # GameData is only loaded once. Every other input is watched.
+    watcher = FileWatcher([assets_dir, root/'shrine_rush_order.csv', root/'inventory_items.yml', routes_dir])
+    try:
+        while True:
+            try:
+                build()
+            except Exception:
+                traceback.print_exc()
+                print('build failed')
+            print('watching for changes (press Ctrl+C to exit)')
+            changed = watcher.wait()
+            for path in sorted(changed)[:10]:
+                print(f'changed: {path.relative_to(root)}')
+            if len(changed) > 10:
+                print(f'... and {len(changed) - 10} more')
+            shared.reset()
+    except KeyboardInterrupt:
+        pass
 
 if __name__ == '__main__':
     main()
@@ -1,8 +1,14 @@
 import abc
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import contextlib
+from fnmatch import fnmatch
+import io
+import os
 from pathlib import Path
 import shutil
+import threading
+import time
 import typing
 import yaml
 
@@ -12,54 +18,452 @@ import byml
 import byml.yaml_util
 import evfl
 from evfl.common import RequiredIndex, Index
-import wszst_yaz0
+
+from compression import CompressionCache, CompressResult, compress_file, compress_file_to_file, compress_to_file, link_or_copy_file, \
+    replace_file
+from gamedata import GameDataIndex, get_bgdata_paths, load_gamedata
+from manifest import BuildManifest, FileInfo, get_file_info, hash_tools, is_same_file
+from profiling import BuildProfiler, Stage
 
 root = Path(__file__).parent
 assets_dir = root / 'assets'
 
+class _BymlLoader(yaml.CSafeLoader):
+    pass
+byml.yaml_util.add_constructors(_BymlLoader)
+
+# AAMP documents get the BYML scalar types too, except for !u which is overridden by aamp.
+class _AampLoader(_BymlLoader):
+    pass
+aamp.yaml_util.register_constructors(_AampLoader)
+
+# Files that are Yaz0 compressed in the final build tree.
+COMPRESSED_NAME_PATTERN = '*.s*'
+
+class AssetOutput(typing.NamedTuple):
+    dest: Path
+    be: bool
+    compress: bool
+
+class AssetJob(typing.NamedTuple):
+    source: Path
+    kind: str # 'copy', 'byml' or 'aamp'
+    # Several outputs (e.g. one per target platform) can be built from a single source.
+    outputs: typing.Tuple[AssetOutput, ...]
+
+def build_asset(job: AssetJob, cache: typing.Optional[CompressionCache]) -> typing.List[CompressResult]:
+    # Every output is written once, in its final form.
+    results: typing.List[CompressResult] = []
+    outputs = []
+    for output in job.outputs:
+        if job.kind == 'copy' and not output.compress:
+            shutil.copy2(job.source, output.dest, follow_symlinks=False)
+        else:
+            outputs.append(output)
+    if not outputs:
+        return results
+
+    if job.kind == 'copy':
+        # Compressed copies are streamed from the source file and never held in memory.
+        # Every output has the same contents, so the source is only compressed once.
+        in_size = job.source.stat().st_size
+        for i, output in enumerate(outputs):
+            start = time.perf_counter()
+            if i == 0:
+                cached = compress_file_to_file(job.source, output.dest, cache)
+            else:
+                link_or_copy_file(outputs[0].dest, output.dest)
+            results.append(CompressResult(output.dest, in_size, output.dest.stat().st_size, time.perf_counter() - start, cached))
+        return results
+
+    start = time.perf_counter()
+    data: typing.Dict[bool, bytes] = dict()
+    with job.source.open('r') as f:
+        doc = yaml.load(f, Loader=_BymlLoader if job.kind == 'byml' else _AampLoader)
+    for be in set(output.be for output in outputs):
+        stream = io.BytesIO()
+        if job.kind == 'byml':
+            byml.Writer(doc, be=be, version=2).write(stream) # type: ignore
+        else:
+            aamp.Writer(doc).write(stream) # type: ignore
+        data[be] = stream.getvalue()
+    prepare_time = time.perf_counter() - start
+
+    for output in outputs:
+        if not output.compress:
+            output.dest.write_bytes(data[output.be])
+            continue
+        start = time.perf_counter()
+        cached = compress_to_file(data[output.be], output.dest, cache)
+        elapsed = prepare_time + time.perf_counter() - start
+        results.append(CompressResult(output.dest, len(data[output.be]), output.dest.stat().st_size, elapsed, cached))
+    return results
+
+def report_compression(results: typing.List[CompressResult], base_dir: Path, jobs: int) -> None:
+    if not results:
+        return
+    total_in = sum(r.in_size for r in results)
+    total_out = sum(r.out_size for r in results)
+    for r in sorted(results, key=lambda r: r.elapsed, reverse=True):
+        status = 'cached' if r.cached else ''
+        print(f'  {r.elapsed:7.3f}s  {r.in_size:>10} -> {r.out_size:>10}  {status:6}  {r.path.relative_to(base_dir)}')
+    num_cached = sum(1 for r in results if r.cached)
+    print(f'compressed {len(results)} files ({total_in} -> {total_out} bytes, {num_cached} from cache) with {jobs} jobs')
+
+# Work lists for the asset stage, produced by a single scan of the assets directory.
+class AssetPlan:
+    def __init__(self) -> None:
+        self.copy: typing.List[AssetJob] = []
+        self.byml: typing.List[AssetJob] = []
+        self.aamp: typing.List[AssetJob] = []
+
+    def get_jobs(self) -> typing.List[AssetJob]:
+        return self.copy + self.byml + self.aamp
+
+# Keeps event flows in memory for the duration of a build so that every generator
+# edits the same EventFlow object, and each flow is parsed and serialized at most once.
+# Flows are identified by their path in the assets directory; edited flows can be saved to several build trees.
+class EventFlowSession:
+    def __init__(self) -> None:
+        self._event_flows: typing.Dict[Path, evfl.EventFlow] = dict()
+        self._dirty_paths: typing.Set[Path] = set()
+        self._data: typing.Dict[Path, bytes] = dict()
+        self._lock = threading.Lock()
+
+    def get(self, path: Path) -> evfl.EventFlow:
+        event_flow = self._event_flows.get(path)
+        if event_flow is None:
+            event_flow = evfl.EventFlow()
+            with path.open('rb') as f:
+                event_flow.read(f.read())
+            self._event_flows[path] = event_flow
+        return event_flow
+
+    @contextlib.contextmanager
+    def edit(self, path: Path) -> typing.Iterator[evfl.EventFlow]:
+        try:
+            yield self.get(path)
+        finally:
+            self._dirty_paths.add(path)
+            self._data.pop(path, None)
+
+    def _serialize(self, path: Path) -> bytes:
+        with self._lock:
+            data = self._data.get(path)
+            if data is None:
+                stream = io.BytesIO()
+                self._event_flows[path].write(stream)
+                data = stream.getvalue()
+                self._data[path] = data
+            return data
+
+    def save(self, source_dir: Path, build_assets_dir: Path) -> typing.List[Path]:
+        saved = []
+        for path in sorted(self._dirty_paths):
+            dest = build_assets_dir/path.relative_to(source_dir)
+            replace_file(dest, self._serialize(path))
+            saved.append(dest)
+        return saved
+
+# Platform independent state that is shared by the builders of a multi-target build.
+class SharedState:
+    def __init__(self) -> None:
+        self.gamedata: typing.Optional[GameDataIndex] = None
+        self.event_flows = EventFlowSession()
+        self.is_project_built = False
+        self.profiler = BuildProfiler()
+        # FileInfo of the project inputs, shared so that each input is only hashed once for all targets.
+        self.input_infos: typing.Dict[Path, FileInfo] = dict()
+
+    def reset(self) -> None:
+        # Prepares for another build in the same process (e.g. in watch mode).
+        # Parsed GameData stays loaded; event flows are reloaded because the project build step edits them.
+        self.event_flows = EventFlowSession()
+        self.is_project_built = False
+        self.profiler = BuildProfiler(self.profiler.cprofile_dir)
+
+def build_targets(builders: typing.List['Builder']) -> None:
+    profiler = builders[0].shared.profiler
+    plans = []
+    for builder in builders:
+        with profiler.stage(f'{builder.build_assets_dir.name}: plan assets') as stage:
+            builder._load_manifest()
+            plan = builder._plan_assets()
+            stage.add(files=len(builder._manifest.assets))
+        plans.append(plan)
+
+    # Merge jobs that share a source so that it is only read and parsed once for all targets.
+    merged_jobs: typing.Dict[typing.Tuple[Path, str], typing.List[AssetOutput]] = defaultdict(list)
+    for plan in plans:
+        for job in plan.get_jobs():
+            merged_jobs[(job.source, job.kind)] += job.outputs
+    jobs = [AssetJob(source, kind, tuple(outputs)) for (source, kind), outputs in merged_jobs.items()]
+    for job in jobs:
+        for output in job.outputs:
+            output.dest.parent.mkdir(parents=True, exist_ok=True)
+
+    num_jobs = builders[0].jobs
+    compression_cache = builders[0].compression_cache
+    # Plain copies are cheap; conversions (YAML parsing, BYML/AAMP writing) and compression are not.
+    fast_jobs = [job for job in jobs if job.kind == 'copy' and not any(output.compress for output in job.outputs)]
+    slow_jobs = [job for job in jobs if job not in fast_jobs]
+    print(f'building assets ({len(fast_jobs)} copies, {len(slow_jobs)} conversions)')
+    results: typing.List[CompressResult] = []
+    with profiler.stage('build assets') as stage:
+        for job in fast_jobs:
+            results += build_asset(job, compression_cache)
+            size = job.source.lstat().st_size
+            stage.add(files=len(job.outputs), bytes_in=size, bytes_out=size * len(job.outputs))
+        if num_jobs > 1 and len(slow_jobs) > 1:
+            with ProcessPoolExecutor(max_workers=num_jobs) as executor:
+                for job_results in executor.map(build_asset, slow_jobs, [compression_cache] * len(slow_jobs)):
+                    results += job_results
+        else:
+            for job in slow_jobs:
+                results += build_asset(job, compression_cache)
+        for job in slow_jobs:
+            stage.add(files=len(job.outputs), bytes_in=job.source.stat().st_size,
+                      bytes_out=sum(output.dest.stat().st_size for output in job.outputs))
+    base_dir = Path(os.path.commonpath([builder.build_assets_dir.parent for builder in builders]))
+    report_compression(results, base_dir, num_jobs)
+
+    # The project build step edits the shared event flows and GameData in place, so it runs exactly once,
+    # before any target writes its outputs. If it fails, the build stops before a target can use the partly
+    # edited state (rerunning the step on it would add the generated events a second time).
+    dirty_builders = [builder for builder in builders if builder._project_dirty]
+    if dirty_builders and not dirty_builders[0].shared.is_project_built:
+        with profiler.stage('build project'):
+            dirty_builders[0]._build_project()
+        dirty_builders[0].shared.is_project_built = True
+
+    # The remaining steps only write to their own build tree.
+    # cProfile can only capture one thread at a time, so targets are finished one after the other when it is used.
+    with ThreadPoolExecutor(max_workers=1 if profiler.cprofile_dir else len(builders)) as executor:
+        for _ in executor.map(lambda builder: builder._finish_build(), builders):
+            pass
+    if compression_cache:
+        with profiler.stage('prune compression cache'):
+            compression_cache.prune()
+
 class Builder(metaclass=abc.ABCMeta):
-    def __init__(self, wiiu: bool, gamedata_dir: Path, build_assets_dir: Path):
+    def __init__(self, wiiu: bool, gamedata_dir: Path, build_assets_dir: Path, jobs: typing.Optional[int] = None,
+                 compression_cache: typing.Optional[CompressionCache] = None, incremental: bool = False,
+                 cache_dir: typing.Optional[Path] = None, shared: typing.Optional[SharedState] = None,
+                 source_assets_dir: Path = assets_dir):
         self.wiiu = wiiu
         self.gamedata_dir = gamedata_dir
+        self.assets_dir = source_assets_dir
         self.build_assets_dir = build_assets_dir
+        self.jobs = jobs or os.cpu_count() or 1
+        self.compression_cache = compression_cache
+        self.incremental = incremental
+        self.cache_dir = cache_dir
+        self.shared = shared or SharedState()
+        self.event_flows = self.shared.event_flows
+        self.profiler = self.shared.profiler
+        self._manifest_path = build_assets_dir.with_name(build_assets_dir.name + '.manifest.json')
+        # Files in the build tree that were written by this build.
+        self._written_paths: typing.Set[Path] = set()
+        # Files that are written or edited by the project build step.
+        self._project_paths: typing.Set[Path] = set()
+        # Outputs (relative to the build tree) that were removed because they are stale.
+        self._stale_outputs: typing.Set[str] = set()
         self._load_gamedata_flags()
 
     def build(self) -> None:
-        self._copy_assets()
-        self._copy_language_packs()
-        self._prepare_platform_specific_resources()
+        build_targets([self])
 
-        self._build_project()
+    def _finish_build(self) -> None:
+        name = self.build_assets_dir.name
+        if self._project_dirty:
+            self._remove_generated_files()
+            with self.profiler.stage(f'{name}: write project outputs') as stage:
+                self._write_project_outputs()
+                for path in self.event_flows.save(self.assets_dir, self.build_assets_dir):
+                    print(f'wrote {path.relative_to(self.build_assets_dir.parent)}')
+                generated_paths = [path for path in self._project_paths if path.is_file()]
+                stage.add(files=len(generated_paths), bytes_out=sum(path.stat().st_size for path in generated_paths))
+            self._compress_project_files()
+        else:
+            print(f'{name}: project inputs are unchanged: skipping project build')
 
-        self._generate_byml()
-        self._generate_aamp()
-        self._compress_assets()
+        self._copy_language_packs()
+        self._manifest.save(self._manifest_path)
 
     @abc.abstractmethod
     def _build_project(self) -> None:
+        # Platform independent part of the project build step. Only runs once for all targets.
+        pass
+
+    def _write_project_outputs(self) -> None:
+        # Platform specific part of the project build step. Runs once per target.
         pass
 
+    def _get_project_inputs(self) -> typing.Dict[str, Path]:
+        # Files outside of the assets directory that the project build step depends on.
+        inputs = dict()
+        for bgdata_path in get_bgdata_paths(self.gamedata_dir):
+            inputs[f'gamedata/{bgdata_path.name}'] = bgdata_path
+        return inputs
+
+    def _get_project_options(self) -> typing.Dict[str, str]:
+        # Build options that change the output of the project build step.
+        return dict()
+
+    def _get_project_assets(self) -> typing.List[Path]:
+        # Assets that are edited in place by the project build step.
+        return []
+
+    def _add_generated_file(self, path: Path) -> None:
+        self._manifest.generated.append(path.relative_to(self.build_assets_dir).as_posix())
+        self._written_paths.add(path)
+        self._project_paths.add(path)
+
+    def _load_manifest(self) -> None:
+        tools = hash_tools(root.glob('*.py'))
+        self._previous_manifest: typing.Optional[BuildManifest] = None
+        if self.incremental and self.build_assets_dir.is_dir():
+            self._previous_manifest = BuildManifest.load(self._manifest_path, tools)
+
+        self._manifest = BuildManifest(tools)
+        previous_inputs = self._previous_manifest.inputs if self._previous_manifest else dict()
+        inputs = self._get_project_inputs()
+        def get_input_info(key: str, path: Path) -> FileInfo:
+            # Files that another target has already hashed are only rehashed if they have been touched since.
+            return get_file_info(path, previous_inputs.get(key) or self.shared.input_infos.get(path))
+        # Hashed in parallel for the same reason as in GameDataIndex._load.
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            infos = list(executor.map(get_input_info, inputs.keys(), inputs.values()))
+        gamedata_digests: typing.Dict[Path, str] = dict()
+        for (key, path), info in zip(inputs.items(), infos):
+            self._manifest.inputs[key] = info
+            self.shared.input_infos[path] = info
+            if key.startswith('gamedata/'):
+                gamedata_digests[path] = str(info['sha256'])
+        # The GameData snapshots are identified by the same hashes.
+        if self.gamedata is not None:
+            self.gamedata.add_digests(gamedata_digests)
+        for key, value in self._get_project_options().items():
+            self._manifest.inputs[f'option/{key}'] = {'value': value}
+        self._project_dirty = self._previous_manifest is None or previous_inputs.keys() != self._manifest.inputs.keys() \
+            or any(not is_same_file(info, previous_inputs.get(key)) for key, info in self._manifest.inputs.items())
+        if not self._project_dirty:
+            assert self._previous_manifest
+            self._manifest.generated = list(self._previous_manifest.generated)
+
     def _load_gamedata_flags(self) -> None:
-        print('loading GameData flags')
-        self.gamedata_bgdata: typing.Dict[str, dict] = dict()
-        self.gamedata_flags: typing.DefaultDict[str, list] = defaultdict(list)
-        for bgdata_path in self.gamedata_dir.glob('*.bgdata'):
-            with bgdata_path.open('rb') as f:
-                bgdata = byml.Byml(f.read()).parse()
-                assert isinstance(bgdata, dict)
-                self.gamedata_bgdata[bgdata_path.name] = bgdata
-            for data_type_key, flags in bgdata.items():
-                data_type = data_type_key[:-5]
-                self.gamedata_flags[data_type] += flags
-        if not self.gamedata_flags:
+        # bgdata files are only parsed when the project build step queries their flags,
+        # so builds that skip that step never parse GameData.
+        if self.shared.gamedata is None:
+            snapshot_dir = self.cache_dir/'gamedata' if self.cache_dir else None
+            self.shared.gamedata = load_gamedata(self.gamedata_dir, self.jobs, snapshot_dir)
+        self.gamedata = self.shared.gamedata
+        if not self.gamedata:
             raise Exception(f'No bgdata was found in {self.gamedata_dir}')
 
-    def _copy_assets(self) -> None:
-        print('copying assets')
+    def _get_source_kind(self, rel: str) -> typing.Tuple[str, str]:
+        # Returns the output name and the kind of conversion for an asset.
+        if not self.wiiu and rel.endswith('.nx'):
+            rel = rel[:-3]
+        if rel.endswith('.yml'):
+            return (rel[:-4], 'byml')
+        if rel.endswith('.aampyml'):
+            return (rel[:-8], 'aamp')
+        return (rel, 'copy')
+
+    def _get_output_name(self, rel: str) -> str:
+        return self._get_source_kind(rel)[0]
+
+    def _remove_output(self, rel: str) -> None:
+        path = self.build_assets_dir/rel
+        if os.path.lexists(path):
+            path.unlink()
+        self._stale_outputs.add(rel)
+
+    def _remove_generated_files(self) -> None:
+        if not self._previous_manifest:
+            return
+        for rel in self._previous_manifest.generated:
+            self._remove_output(rel)
+
+    def _scan_assets(self) -> typing.Dict[str, Path]:
+        sources: typing.Dict[str, Path] = dict()
+        for dir_path, dir_names, file_names in os.walk(self.assets_dir):
+            # Directory symlinks are copied as symlinks (like files), not followed.
+            for name in file_names + [d for d in dir_names if os.path.islink(os.path.join(dir_path, d))]:
+                path = Path(dir_path)/name
+                sources[path.relative_to(self.assets_dir).as_posix()] = path
+        return sources
+
+    def _plan_assets(self) -> AssetPlan:
+        print('scanning assets')
         self.build_assets_dir.parent.mkdir(exist_ok=True)
-        if self.build_assets_dir.is_dir():
-            raise ValueError(f'{self.build_assets_dir} already exists')
-        shutil.copytree(assets_dir, self.build_assets_dir, symlinks=True)
+        if self.build_assets_dir.is_dir() and not self._previous_manifest:
+            if not self.incremental:
+                raise ValueError(f'{self.build_assets_dir} already exists')
+            print(f'{self.build_assets_dir} has no usable build manifest: rebuilding from scratch')
+            shutil.rmtree(self.build_assets_dir)
+        self.build_assets_dir.mkdir(exist_ok=True)
+
+        previous_assets = self._previous_manifest.assets if self._previous_manifest else dict()
+        sources = self._scan_assets()
+        # Several assets can map to the same output (e.g. foo.msbt and foo.msbt.nx on Switch).
+        # The last one in sorted order (i.e. the platform specific variant) is used.
+        output_sources: typing.Dict[str, str] = dict()
+        for rel in sorted(sources):
+            output_sources[self._get_output_name(rel)] = rel
+
+        dirty_outputs: typing.Set[str] = set()
+        for rel, path in sources.items():
+            info = get_file_info(path, previous_assets.get(rel))
+            self._manifest.assets[rel] = info
+            output = self._get_output_name(rel)
+            if not is_same_file(info, previous_assets.get(rel)) or not os.path.lexists(self.build_assets_dir/output):
+                dirty_outputs.add(output)
+        for rel in previous_assets.keys() - sources.keys():
+            output = self._get_output_name(rel)
+            if output in output_sources:
+                dirty_outputs.add(output)
+            else:
+                self._remove_output(output)
+
+        project_outputs = set(self._get_output_name(path.relative_to(self.assets_dir).as_posix()) for path in self._get_project_assets())
+        if dirty_outputs & project_outputs:
+            self._project_dirty = True
+        if self._project_dirty:
+            # Edits are applied on top of a pristine copy of the asset.
+            dirty_outputs |= project_outputs
+
+        plan = AssetPlan()
+        for output in sorted(dirty_outputs):
+            self._remove_output(output)
+            rel = output_sources[output]
+            source = sources[rel]
+            dest = self.build_assets_dir/output
+            kind = self._get_source_kind(rel)[1]
+            if output in project_outputs:
+                # Project assets are compressed after they have been edited.
+                compress = False
+                self._project_paths.add(dest)
+            else:
+                compress = fnmatch(dest.name, COMPRESSED_NAME_PATTERN) and not source.is_symlink() and not source.is_dir()
+            getattr(plan, kind).append(AssetJob(source, kind, (AssetOutput(dest, self.wiiu, compress),)))
+            self._written_paths.add(dest)
+        self._save_pending_manifest(previous_assets, dirty_outputs)
+        print(f'{self.build_assets_dir.name}: {len(dirty_outputs)} of {len(sources)} assets need to be built')
+        return plan
+
+    def _save_pending_manifest(self, previous_assets: typing.Dict[str, FileInfo], dirty_outputs: typing.Set[str]) -> None:
+        # If this build fails, the next one must not mistake the build tree for an up-to-date one,
+        # but it should not have to start from scratch either. Until the build has finished, the manifest
+        # only vouches for the outputs that this build does not touch.
+        pending = BuildManifest(self._manifest.tools)
+        pending.assets = {rel: info for rel, info in previous_assets.items() if self._get_output_name(rel) not in dirty_outputs}
+        if self._previous_manifest:
+            # Leaving out the inputs makes the next build rerun the project build step if this one was going to.
+            pending.inputs = self._previous_manifest.inputs if not self._project_dirty else dict()
+            pending.generated = list(self._previous_manifest.generated)
+        pending.save(self._manifest_path)
 
     def _copy_language_packs(self) -> None:
         LANGUAGES = (
@@ -81,47 +485,44 @@ class Builder(metaclass=abc.ABCMeta):
         if self.wiiu:
             return
         print('copying messages')
-        source_lang_file_dir = self.build_assets_dir/'Pack'/'Bootup_EUen.pack'/'Message'/'Msg_EUen.product.ssarc'
-        for lang in LANGUAGES:
-            lang_message_dir = self.build_assets_dir/'Pack'/f'Bootup_{lang}.pack'/'Message'
-            lang_message_dir.mkdir(parents=True)
-            shutil.copytree(source_lang_file_dir, lang_message_dir/f'Msg_{lang}.product.ssarc', symlinks=True)
-
-    def _prepare_platform_specific_resources(self) -> None:
-        if not self.wiiu:
-            print('preparing Switch specific resources')
-            for path in self.build_assets_dir.glob('**/*.nx'):
-                path.rename(str(path)[:-3])
-
-    def _generate_byml(self) -> None:
-        print('generating BYMLs')
-        byml.yaml_util.add_constructors(yaml.CSafeLoader)
-        for path in self.build_assets_dir.glob('**/*.yml'):
-            with path.open('r') as f:
-                data = yaml.load(f, Loader=yaml.CSafeLoader)
-            writer = byml.Writer(data, be=self.wiiu, version=2)
-            with Path(str(path)[:-4]).open('wb') as f:
-                writer.write(f) # type: ignore
-            path.unlink()
+        with self.profiler.stage(f'{self.build_assets_dir.name}: copy language packs') as stage:
+            self._fan_out_language_packs(LANGUAGES, stage)
 
-    def _generate_aamp(self) -> None:
-        print('generating AAMPs')
-        aamp.yaml_util.register_constructors(yaml.CSafeLoader)
-        for path in self.build_assets_dir.glob('**/*.aampyml'):
-            with path.open('r') as f:
-                data = yaml.load(f, Loader=yaml.CSafeLoader)
-            writer = aamp.Writer(data)
-            with Path(str(path)[:-8]).open('wb') as f:
-                writer.write(f) # type: ignore
-            path.unlink()
+    def _fan_out_language_packs(self, languages: typing.Iterable[str], stage: Stage) -> None:
+        source_lang_file_dir = self.build_assets_dir/'Pack'/'Bootup_EUen.pack'/'Message'/'Msg_EUen.product.ssarc'
+        source_prefix = source_lang_file_dir.relative_to(self.build_assets_dir).as_posix() + '/'
+        stale_files = [rel[len(source_prefix):] for rel in sorted(self._stale_outputs) if rel.startswith(source_prefix)]
+        dirty_files = sorted(path for path in self._written_paths if source_lang_file_dir in path.parents)
+        # Message files are not Yaz0 compressed by the build, so every language can share
+        # the source files instead of getting its own copy.
+        methods: typing.Dict[str, int] = defaultdict(int)
+        for lang in languages:
+            lang_file_dir = self.build_assets_dir/'Pack'/f'Bootup_{lang}.pack'/'Message'/f'Msg_{lang}.product.ssarc'
+            for rel in stale_files:
+                self._remove_output((lang_file_dir/rel).relative_to(self.build_assets_dir).as_posix())
+            for path in dirty_files:
+                dest = lang_file_dir/path.relative_to(source_lang_file_dir)
+                dest.parent.mkdir(parents=True, exist_ok=True)
+                if path.is_symlink():
+                    shutil.copy2(path, dest, follow_symlinks=False)
+                    methods['symlink'] += 1
+                else:
+                    methods[link_or_copy_file(path, dest)] += 1
+                self._written_paths.add(dest)
+                stage.add()
+        if methods:
+            print('messages: ' + ', '.join(f'{count} {method}' for method, count in sorted(methods.items())))
 
-    def _compress_assets(self) -> None:
-        print('compressing assets')
-        for path in self.build_assets_dir.glob('**/*.s*'):
-            if path.is_dir():
-                continue
-            tmp_path = path.with_suffix('.tmp')
-            path.rename(tmp_path)
-            with tmp_path.open('rb') as srcf, path.open('wb') as destf:
-                destf.write(wszst_yaz0.compress(srcf.read()))
-            tmp_path.unlink()
+    def _compress_project_files(self) -> None:
+        paths = sorted(path for path in self._project_paths
+                       if fnmatch(path.name, COMPRESSED_NAME_PATTERN) and path.is_file() and not path.is_symlink())
+        if not paths:
+            return
+        print('compressing project files')
+        with self.profiler.stage(f'{self.build_assets_dir.name}: compress project files') as stage:
+            # wszst_yaz0 compresses in a wszst subprocess, so threads are enough to keep every core busy.
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                results = list(executor.map(lambda path: compress_file(path, self.compression_cache), paths))
+            for result in results:
+                stage.add(bytes_in=result.in_size, bytes_out=result.out_size)
+        report_compression(results, self.build_assets_dir.parent, self.jobs)
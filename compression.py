@@ -0,0 +1,255 @@
+import contextlib
+import hashlib
+import mmap
+import os
+from pathlib import Path
+import shutil
+import subprocess
+import tempfile
+import time
+import typing
+
+import wszst_yaz0
+
+# Anything that can change the compressed output for a given input must be part of this identity.
+COMPRESSION_LEVEL = 10
+COMPRESSOR_ID = f'wszst_yaz0:yaz0:level={COMPRESSION_LEVEL}'.encode()
+YAZ0_MAGIC = b'Yaz0'
+
+_WSZST = 'wszst' if os.name != 'nt' else 'wszst.exe'
+
+class CompressResult(typing.NamedTuple):
+    path: Path
+    in_size: int
+    out_size: int
+    elapsed: float
+    cached: bool
+
+def _get_default_file_mode() -> int:
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+_DEFAULT_FILE_MODE = _get_default_file_mode()
+
+def _make_temp_path(path: Path) -> Path:
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.', suffix='.tmp')
+    os.close(fd)
+    return Path(tmp_path)
+
+def _replace_with_temp_file(tmp_path: Path, path: Path) -> None:
+    if path.exists():
+        shutil.copymode(path, tmp_path)
+    else:
+        tmp_path.chmod(_DEFAULT_FILE_MODE)
+    os.replace(tmp_path, path)
+
+@contextlib.contextmanager
+def open_replacement_file(path: Path, mode: str = 'wb') -> typing.Iterator[typing.IO]:
+    # Writes to a uniquely named sibling temporary file that replaces path once it has been closed,
+    # so that readers never see a partially written file and concurrent writers do not clobber each other.
+    tmp_path = _make_temp_path(path)
+    try:
+        with tmp_path.open(mode) as f:
+            yield f
+        _replace_with_temp_file(tmp_path, path)
+    except BaseException:
+        if tmp_path.exists():
+            tmp_path.unlink()
+        raise
+
+def replace_file(path: Path, data: bytes) -> None:
+    with open_replacement_file(path) as f:
+        f.write(data)
+
+@contextlib.contextmanager
+def _map_file(path: Path) -> typing.Iterator[typing.Union[bytes, mmap.mmap]]:
+    with path.open('rb') as f:
+        # Empty files cannot be mapped.
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b''
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield mm
+
+@contextlib.contextmanager
+def map_decompressed_file(path: Path) -> typing.Iterator[typing.Union[bytes, mmap.mmap]]:
+    # Maps a file that may or may not be Yaz0 compressed.
+    # Uncompressed files are not read into memory at all; compressed files are decompressed straight from a mapping.
+    with _map_file(path) as data:
+        if data[0:4] != YAZ0_MAGIC:
+            yield data
+        else:
+            yield wszst_yaz0.decompress(data) # type: ignore
+
+def read_decompressed_file(path: Path) -> bytes:
+    with map_decompressed_file(path) as data:
+        return bytes(data)
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None # type: ignore
+
+# ioctl(FICLONE) from linux/fs.h: makes dest share the extents of src on filesystems that support it (Btrfs, XFS).
+_FICLONE = 0x40049409
+
+def _reflink_file(src: Path, dest: Path) -> bool:
+    if fcntl is None:
+        return False
+    with src.open('rb') as src_f, dest.open('wb') as dest_f:
+        try:
+            fcntl.ioctl(dest_f.fileno(), _FICLONE, src_f.fileno())
+        except OSError:
+            return False
+    return True
+
+def link_or_copy_file(src: Path, dest: Path) -> str:
+    # Hardlink when possible; otherwise try a reflink, and fall back to a copy
+    # (e.g. when src and dest are on different filesystems).
+    # Returns the method that was used: 'link', 'reflink' or 'copy'.
+    # Renaming a file over another link to the same file does nothing, so that case has to be caught early.
+    if dest.exists() and os.path.samefile(src, dest):
+        return 'link'
+    tmp_path = _make_temp_path(dest)
+    try:
+        tmp_path.unlink()
+        try:
+            os.link(src, tmp_path)
+            method = 'link'
+        except OSError:
+            if _reflink_file(src, tmp_path):
+                method = 'reflink'
+            else:
+                shutil.copyfile(src, tmp_path)
+                method = 'copy'
+        os.replace(tmp_path, dest)
+    except BaseException:
+        if tmp_path.exists():
+            tmp_path.unlink()
+        raise
+    return method
+
+def reflink_or_copy_file(src: Path, dest: Path) -> str:
+    # Like link_or_copy_file, but never hardlinks: dest gets its own inode and the default file mode,
+    # so it does not share (or inherit) the mode of src.
+    # Returns the method that was used: 'reflink' or 'copy'.
+    tmp_path = _make_temp_path(dest)
+    try:
+        if _reflink_file(src, tmp_path):
+            method = 'reflink'
+        else:
+            shutil.copyfile(src, tmp_path)
+            method = 'copy'
+        tmp_path.chmod(_DEFAULT_FILE_MODE)
+        os.replace(tmp_path, dest)
+    except BaseException:
+        if tmp_path.exists():
+            tmp_path.unlink()
+        raise
+    return method
+
+# Content-addressed store of Yaz0 compressed files, keyed by the uncompressed bytes and the compressor identity.
+# Least recently used entries are evicted when the cache grows past max_size bytes.
+# Blobs are read-only. They are reflinked or copied into build trees, never hardlinked, so that build outputs
+# stay writable and cannot be used to modify the cache.
+class CompressionCache:
+    def __init__(self, cache_dir: Path, max_size: int) -> None:
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def get_key(data: typing.Union[bytes, mmap.mmap]) -> str:
+        h = hashlib.sha256(COMPRESSOR_ID)
+        h.update(b'\0')
+        h.update(data)
+        return h.hexdigest()
+
+    @staticmethod
+    def get_file_key(path: Path) -> str:
+        with _map_file(path) as data:
+            return CompressionCache.get_key(data)
+
+    def _get_blob_path(self, key: str) -> Path:
+        return self.cache_dir/key[:2]/key
+
+    def fetch(self, key: str, dest: Path) -> bool:
+        blob_path = self._get_blob_path(key)
+        try:
+            # Bump the modification time: it is used as the last access time for eviction.
+            os.utime(blob_path)
+            reflink_or_copy_file(blob_path, dest)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def store(self, key: str, data: bytes) -> None:
+        blob_path = self._get_blob_path(key)
+        blob_path.parent.mkdir(exist_ok=True)
+        tmp_path = _make_temp_path(blob_path)
+        with tmp_path.open('wb') as f:
+            f.write(data)
+        tmp_path.chmod(0o444)
+        os.replace(tmp_path, blob_path)
+
+    def store_file(self, key: str, path: Path) -> None:
+        blob_path = self._get_blob_path(key)
+        blob_path.parent.mkdir(exist_ok=True)
+        tmp_path = _make_temp_path(blob_path)
+        shutil.copyfile(path, tmp_path)
+        tmp_path.chmod(0o444)
+        os.replace(tmp_path, blob_path)
+
+    def prune(self) -> None:
+        entries = []
+        total_size = 0
+        for blob_path in self.cache_dir.glob('*/*'):
+            if blob_path.name.endswith('.tmp'):
+                continue
+            st = blob_path.stat()
+            entries.append((st.st_mtime, st.st_size, blob_path))
+            total_size += st.st_size
+        entries.sort()
+        for _, size, blob_path in entries:
+            if total_size <= self.max_size:
+                break
+            blob_path.unlink()
+            total_size -= size
+
+def compress_to_file(data: bytes, dest: Path, cache: typing.Optional[CompressionCache] = None) -> bool:
+    # Returns whether the compressed data was fetched from the cache.
+    key = cache.get_key(data) if cache else ''
+    if cache and cache.fetch(key, dest):
+        return True
+    compressed = wszst_yaz0.compress(data, level=COMPRESSION_LEVEL)
+    if cache:
+        cache.store(key, compressed)
+    replace_file(dest, compressed)
+    return False
+
+def compress_file_to_file(src: Path, dest: Path, cache: typing.Optional[CompressionCache] = None) -> bool:
+    # Streaming variant of compress_to_file: the input is fed to wszst straight from the file
+    # and the output goes to a sibling temporary file, so neither is held in memory.
+    # src and dest may be the same file. Returns whether the compressed data was fetched from the cache.
+    key = cache.get_file_key(src) if cache else ''
+    if cache and cache.fetch(key, dest):
+        return True
+    tmp_path = _make_temp_path(dest)
+    try:
+        with src.open('rb') as src_f, tmp_path.open('wb') as tmp_f:
+            subprocess.run([_WSZST, 'comp', '-', '-d-', f'-C{COMPRESSION_LEVEL}', '-M1000'],
+                           stdin=src_f, stdout=tmp_f, stderr=subprocess.PIPE, check=True)
+        if cache:
+            cache.store_file(key, tmp_path)
+        _replace_with_temp_file(tmp_path, dest)
+    except BaseException:
+        tmp_path.unlink()
+        raise
+    return False
+
+def compress_file(path: Path, cache: typing.Optional[CompressionCache] = None) -> CompressResult:
+    start = time.perf_counter()
+    in_size = path.stat().st_size
+    cached = compress_file_to_file(path, path, cache)
+    return CompressResult(path, in_size, path.stat().st_size, time.perf_counter() - start, cached)
@@ -0,0 +1,195 @@
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import mmap
+from pathlib import Path
+import pickle
+import re
+import threading
+import typing
+
+import byml
+
+from compression import map_decompressed_file, open_replacement_file
+from manifest import hash_file
+
+# Bump this whenever the parsed representation changes to invalidate existing snapshots.
+SNAPSHOT_VERSION = 2
+
+class GameDataFlag(typing.NamedTuple):
+    bgdata_name: str
+    data_type: str
+    flag: dict
+
+def _get_flag_dungeon_number(name: str) -> typing.Optional[int]:
+    # e.g. 0 for Dungeon000_TreasureBox_1, whose name starts with the map name of the shrine.
+    if name.startswith('Dungeon') and name[7:10].isdigit():
+        return int(name[7:10])
+    return None
+
+def _get_segment(name: str) -> str:
+    # e.g. 'CDungeon_' for CDungeon_Dungeon000_Clear
+    i = name.find('_')
+    return name[:i+1] if i != -1 else name
+
+class _BgdataIndex:
+    # Index of the flags in a single bgdata file.
+    def __init__(self, bgdata_name: str, bgdata: dict) -> None:
+        self.bgdata = bgdata
+        self.flags: typing.Dict[str, typing.List[dict]] = dict()
+        self.by_name: typing.DefaultDict[str, typing.List[GameDataFlag]] = defaultdict(list)
+        self.by_segment: typing.DefaultDict[typing.Tuple[str, str], typing.List[dict]] = defaultdict(list)
+        self.by_dungeon: typing.DefaultDict[typing.Tuple[int, str], typing.List[dict]] = defaultdict(list)
+        for data_type_key, flags in bgdata.items():
+            data_type = data_type_key[:-5]
+            self.flags[data_type] = flags
+            for flag in flags:
+                name: str = flag['DataName']
+                self.by_name[name].append(GameDataFlag(bgdata_name, data_type, flag))
+                self.by_segment[(data_type, _get_segment(name))].append(flag)
+                dungeon = _get_flag_dungeon_number(name)
+                if dungeon is not None:
+                    self.by_dungeon[(dungeon, data_type)].append(flag)
+
+# e.g. bool_data_0.bgdata, revival_s32_data.bgdata or s32_array_data.sbgdata
+_BGDATA_NAME_RE = re.compile(r'^(?:revival_)?(\w+?)_data(?:_\d+)?\.s?bgdata$')
+
+# Files whose name prefix differs from the type of the flags they contain.
+# string32_data_*.bgdata holds string_data (unlike string64_data.bgdata and string256_data.bgdata).
+_BGDATA_NAME_TYPES = {
+    'string32': 'string',
+}
+
+def _get_bgdata_type(path: Path) -> typing.Optional[str]:
+    # The game only puts flags of a single type in each file. Returns None if the name does not tell.
+    m = _BGDATA_NAME_RE.match(path.name)
+    return _BGDATA_NAME_TYPES.get(m.group(1), m.group(1)) if m else None
+
+# Lazy view of the GameData flags, indexed by name, by name prefix and by dungeon number
+# so that flag lookups do not need to scan every flag.
+# A bgdata file is only parsed when flags of its type are queried (files whose name does not tell
+# the type are parsed by any query). Flags are returned in bgdata file order.
+class GameDataIndex:
+    def __init__(self, paths: typing.List[Path], jobs: int = 1, snapshot_dir: typing.Optional[Path] = None) -> None:
+        self.paths = paths
+        self.jobs = jobs
+        self.snapshot_dir = snapshot_dir
+        self._paths_by_name = {get_bgdata_name(path): path for path in paths}
+        self._files: typing.Dict[Path, _BgdataIndex] = dict()
+        # sha256 of the (raw) files, which identifies their snapshots. Usually known from the build manifest.
+        self._digests: typing.Dict[Path, str] = dict()
+        self._lock = threading.Lock()
+
+    def __bool__(self) -> bool:
+        return bool(self.paths)
+
+    def add_digests(self, digests: typing.Dict[Path, str]) -> None:
+        with self._lock:
+            self._digests.update(digests)
+
+    def _get_files(self, data_type: typing.Optional[str] = None) -> typing.List[_BgdataIndex]:
+        paths = [path for path in self.paths if data_type is None or _get_bgdata_type(path) in (data_type, None)]
+        with self._lock:
+            self._load([path for path in paths if path not in self._files])
+            return [self._files[path] for path in paths]
+
+    def _load(self, paths: typing.List[Path]) -> None:
+        if not paths:
+            return
+        print(f'loading GameData flags ({len(paths)} file(s))')
+        if self.snapshot_dir:
+            # Hashing is I/O bound (the GameData directory is often a FUSE mount).
+            unknown_paths = [path for path in paths if path not in self._digests]
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                self._digests.update(zip(unknown_paths, executor.map(hash_file, unknown_paths)))
+
+        results: typing.Dict[Path, dict] = dict()
+        to_parse: typing.List[typing.Tuple[Path, typing.Optional[Path]]] = []
+        for path in paths:
+            snapshot_path = None
+            if self.snapshot_dir:
+                snapshot_path = self.snapshot_dir/f'{self._digests[path]}.v{SNAPSHOT_VERSION}.pickle'
+            bgdata = _load_snapshot(snapshot_path) if snapshot_path else None
+            if bgdata is not None:
+                results[path] = bgdata
+            else:
+                to_parse.append((path, snapshot_path))
+
+        # Parsing is CPU bound. Workers map the files themselves so that their contents are not pickled.
+        if len(to_parse) > 1 and self.jobs > 1:
+            with ProcessPoolExecutor(max_workers=min(self.jobs, len(to_parse))) as executor:
+                parsed = list(executor.map(parse_bgdata_file, [path for path, _ in to_parse]))
+        else:
+            parsed = [parse_bgdata_file(path) for path, _ in to_parse]
+        for (path, snapshot_path), bgdata in zip(to_parse, parsed):
+            results[path] = bgdata
+            if snapshot_path:
+                _save_snapshot(snapshot_path, bgdata)
+
+        for path in paths:
+            self._files[path] = _BgdataIndex(get_bgdata_name(path), results[path])
+
+    @property
+    def data_types(self) -> typing.List[str]:
+        data_types: typing.List[str] = []
+        for file in self._get_files():
+            data_types += [data_type for data_type in file.flags if data_type not in data_types]
+        return data_types
+
+    def get_bgdata(self, bgdata_name: str) -> dict:
+        path = self._paths_by_name[bgdata_name]
+        with self._lock:
+            self._load([path] if path not in self._files else [])
+            return self._files[path].bgdata
+
+    def get_flags(self, data_type: str) -> typing.List[dict]:
+        return [flag for file in self._get_files(data_type) for flag in file.flags.get(data_type, [])]
+
+    def find(self, name: str, data_type: typing.Optional[str] = None) -> typing.List[GameDataFlag]:
+        entries = [entry for file in self._get_files(data_type) for entry in file.by_name.get(name, [])]
+        return [entry for entry in entries if data_type is None or entry.data_type == data_type]
+
+    def find_by_prefix(self, data_type: str, prefix: str) -> typing.List[dict]:
+        if prefix.endswith('_') and prefix.find('_') == len(prefix) - 1:
+            return [flag for file in self._get_files(data_type) for flag in file.by_segment.get((data_type, prefix), [])]
+        return [flag for flag in self.get_flags(data_type) if flag['DataName'].startswith(prefix)]
+
+    def find_dungeon_flags(self, dungeon: int) -> typing.Iterator[typing.Tuple[str, dict]]:
+        # Flags whose name starts with Dungeon%03d, grouped by data type.
+        files = self._get_files()
+        for data_type in self.data_types:
+            for file in files:
+                yield from ((data_type, flag) for flag in file.by_dungeon.get((dungeon, data_type), []))
+
+def parse_bgdata(data: typing.Union[bytes, mmap.mmap]) -> dict:
+    bgdata = byml.Byml(data).parse()
+    assert isinstance(bgdata, dict)
+    return bgdata
+
+def parse_bgdata_file(path: Path) -> dict:
+    # Parses straight from a mapping of the file. Only Yaz0 compressed files need to be read into memory.
+    with map_decompressed_file(path) as data:
+        return parse_bgdata(data)
+
+def get_bgdata_paths(gamedata_dir: Path) -> typing.List[Path]:
+    # bgdata files may also be Yaz0 compressed (.sbgdata).
+    return sorted(list(gamedata_dir.glob('*.bgdata')) + list(gamedata_dir.glob('*.sbgdata')))
+
+def get_bgdata_name(path: Path) -> str:
+    # Name of the (uncompressed) bgdata file in gamedata.ssarc.
+    return path.stem + '.bgdata' if path.suffix == '.sbgdata' else path.name
+
+def _load_snapshot(snapshot_path: Path) -> typing.Optional[dict]:
+    try:
+        with snapshot_path.open('rb') as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+def _save_snapshot(snapshot_path: Path, bgdata: dict) -> None:
+    snapshot_path.parent.mkdir(parents=True, exist_ok=True)
+    with open_replacement_file(snapshot_path) as f:
+        pickle.dump(bgdata, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def load_gamedata(gamedata_dir: Path, jobs: int, snapshot_dir: typing.Optional[Path] = None) -> GameDataIndex:
+    # Nothing is parsed until flags are queried.
+    return GameDataIndex(get_bgdata_paths(gamedata_dir), jobs, snapshot_dir)
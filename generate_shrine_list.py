@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
+import argparse
 import csv
+import importlib
 from pathlib import Path
+import random
 import typing
 
 class Shrine(typing.NamedTuple):
@@ -9,6 +12,26 @@ class Shrine(typing.NamedTuple):
     sub: str
 
 root = Path(__file__).parent
+routes_dir = root/'routes'
+
+# A strategy generates a shrine order. Strategies that are not random ignore the random number generator.
+Strategy = typing.Callable[[random.Random], typing.List[Shrine]]
+STRATEGIES: typing.Dict[str, Strategy] = dict()
+
+def strategy(name: str) -> typing.Callable[[Strategy], Strategy]:
+    def register(fn: Strategy) -> Strategy:
+        STRATEGIES[name] = fn
+        return fn
+    return register
+
+def get_strategy(name: str) -> Strategy:
+    # Strategies can also be loaded from other modules (module:function).
+    if ':' in name:
+        module_name, fn_name = name.split(':', 1)
+        return getattr(importlib.import_module(module_name), fn_name)
+    if name not in STRATEGIES:
+        raise ValueError(f'Unknown strategy: {name} (available: {", ".join(sorted(STRATEGIES))})')
+    return STRATEGIES[name]
 
 def load_shrine_list():
     shrines: typing.List[Shrine] = []
@@ -35,9 +58,7 @@ def load_shrine_list():
 
     return (shrines, normal_shrines, blessing_shrines, combat_shrines)
 
-def generate_shrines():
-    shrines, normal_shrines, blessing_shrines, combat_shrines = load_shrine_list()
-
+def _interleave(shrines, normal_shrines, blessing_shrines, combat_shrines):
     counter = 0
     while normal_shrines or blessing_shrines or combat_shrines:
         m = counter % 5
@@ -53,14 +74,77 @@ def generate_shrines():
 
     return shrines
 
-def main():
-    shrines = generate_shrines()
-    for i, shrine in enumerate(shrines):
-        print(i, shrine)
-    with (root/'shrine_rush_order.csv').open('w') as f:
+@strategy('interleave')
+def generate_shrines(rng: typing.Optional[random.Random] = None):
+    return _interleave(*load_shrine_list())
+
+@strategy('interleave-random')
+def generate_random_interleaved_shrines(rng: random.Random):
+    # Same category pattern as 'interleave', but the shrines of each category are shuffled.
+    shrines, normal_shrines, blessing_shrines, combat_shrines = load_shrine_list()
+    for l in (normal_shrines, blessing_shrines, combat_shrines):
+        rng.shuffle(l)
+    return _interleave(shrines, normal_shrines, blessing_shrines, combat_shrines)
+
+@strategy('random')
+def generate_random_shrines(rng: random.Random):
+    # The starting shrines stay in place; every other shrine is in a random order.
+    shrines, normal_shrines, blessing_shrines, combat_shrines = load_shrine_list()
+    others = normal_shrines + blessing_shrines + combat_shrines
+    rng.shuffle(others)
+    return shrines + others
+
+CATEGORIES = {
+    'blessing': lambda shrine: shrine.sub.endswith(' Blessing'),
+    'combat': lambda shrine: shrine.sub.endswith(' Test of Strength'),
+}
+
+def exclude_categories(shrines: typing.List[Shrine], categories: typing.Iterable[str]) -> typing.List[Shrine]:
+    predicates = [CATEGORIES[category] for category in categories]
+    return [shrine for shrine in shrines if not any(predicate(shrine) for predicate in predicates)]
+
+def generate_routes(strategy_name: str, seeds: typing.Iterable[int],
+                    exclude: typing.Iterable[str] = ()) -> typing.Iterator[typing.Tuple[int, typing.List[Shrine]]]:
+    fn = get_strategy(strategy_name)
+    exclude = list(exclude)
+    for seed in seeds:
+        yield (seed, exclude_categories(fn(random.Random(seed)), exclude))
+
+def load_route(path: Path) -> typing.List[Shrine]:
+    with path.open('r') as f:
+        return [Shrine(row['map_name'], row['title'], row['sub']) for row in csv.DictReader(f)]
+
+def write_route(path: Path, shrines: typing.List[Shrine]) -> None:
+    with path.open('w') as f:
         writer = csv.DictWriter(f, ['map_name', 'title', 'sub'])
         writer.writeheader()
         writer.writerows([shrine._asdict() for shrine in shrines])
 
+def main():
+    parser = argparse.ArgumentParser(description='Generate shrine orders')
+    parser.add_argument('-s', '--strategy', default='interleave',
+                        help=f'Order strategy ({", ".join(sorted(STRATEGIES))}, or module:function for a custom one)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the first route')
+    parser.add_argument('-n', '--count', type=int, default=1, help='Number of routes to generate (with consecutive seeds)')
+    parser.add_argument('-x', '--exclude', action='append', choices=sorted(CATEGORIES), default=[],
+                        help='Leave out a shrine category (can be repeated)')
+    parser.add_argument('--name', help='Write routes to routes/<name>_<seed>.csv instead of writing shrine_rush_order.csv')
+    args = parser.parse_args()
+
+    if not args.name:
+        if args.count != 1:
+            parser.error('--count requires --name')
+        _, shrines = next(generate_routes(args.strategy, [args.seed], args.exclude))
+        for i, shrine in enumerate(shrines):
+            print(i, shrine)
+        write_route(root/'shrine_rush_order.csv', shrines)
+        return
+
+    routes_dir.mkdir(exist_ok=True)
+    for seed, shrines in generate_routes(args.strategy, range(args.seed, args.seed + args.count), args.exclude):
+        path = routes_dir/f'{args.name}_{seed}.csv'
+        write_route(path, shrines)
+        print(f'wrote {path.relative_to(root)} ({len(shrines)} shrines)')
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,83 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+import stat
+import typing
+
+from compression import open_replacement_file
+
+MANIFEST_VERSION = 1
+
+FileInfo = typing.Dict[str, typing.Union[int, str]]
+
+def hash_file(path: Path) -> str:
+    h = hashlib.sha256()
+    with path.open('rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def get_file_info(path: Path, previous: typing.Optional[FileInfo] = None) -> FileInfo:
+    st = os.lstat(path)
+    if stat.S_ISLNK(st.st_mode):
+        # Symlinks are copied as symlinks, so only the link target matters.
+        return {'link': os.readlink(path)}
+    info: FileInfo = {'mtime_ns': st.st_mtime_ns, 'size': st.st_size}
+    # Only rehash files that have been touched since the previous build.
+    if previous and previous.get('mtime_ns') == st.st_mtime_ns and previous.get('size') == st.st_size:
+        info['sha256'] = previous['sha256']
+    else:
+        info['sha256'] = hash_file(path)
+    return info
+
+def is_same_file(a: typing.Optional[FileInfo], b: typing.Optional[FileInfo]) -> bool:
+    if a is None or b is None:
+        return False
+    return a.get('link') == b.get('link') and a.get('sha256') == b.get('sha256') and a.get('value') == b.get('value')
+
+def hash_tools(paths: typing.Iterable[Path]) -> str:
+    h = hashlib.sha256()
+    for path in sorted(paths):
+        h.update(path.name.encode() + b'\0')
+        h.update(path.read_bytes())
+    return h.hexdigest()
+
+# Records the state of every build input so that incremental builds can tell what has changed.
+# Sections:
+#  - tools: hash of the build scripts; a mismatch invalidates the whole manifest
+#  - assets: asset path (relative to the assets directory) -> FileInfo
+#  - inputs: other inputs (configuration files, GameData) -> FileInfo, and build options (option/*) -> {'value': ...}
+#  - generated: build tree paths that were written by the project build step
+class BuildManifest:
+    def __init__(self, tools: str) -> None:
+        self.tools = tools
+        self.assets: typing.Dict[str, FileInfo] = dict()
+        self.inputs: typing.Dict[str, FileInfo] = dict()
+        self.generated: typing.List[str] = []
+
+    @staticmethod
+    def load(path: Path, tools: str) -> typing.Optional['BuildManifest']:
+        try:
+            with path.open('r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get('version') != MANIFEST_VERSION or data.get('tools') != tools:
+            return None
+        manifest = BuildManifest(tools)
+        manifest.assets = data['assets']
+        manifest.inputs = data['inputs']
+        manifest.generated = data['generated']
+        return manifest
+
+    def save(self, path: Path) -> None:
+        data = {
+            'version': MANIFEST_VERSION,
+            'tools': self.tools,
+            'assets': self.assets,
+            'inputs': self.inputs,
+            'generated': sorted(self.generated),
+        }
+        with open_replacement_file(path, 'w') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
@@ -0,0 +1,80 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+import subprocess
+import tempfile
+import time
+import typing
+
+from manifest import hash_file
+
+# Anything that changes the archive for a given input tree must be part of this identity.
+# Timestamps are not stored and entries are added in sorted order so that archives only depend on file contents.
+ARCHIVE_SETTINGS = ['-t7z', '-mx=9', '-ms=on', '-mqs=on', '-mtm=off', '-mtc=off', '-mta=off']
+
+_7Z = '7z' if os.name != 'nt' else '7z.exe'
+
+def _list_files(tree: Path) -> typing.List[str]:
+    files = []
+    for dir_path, _, file_names in os.walk(tree):
+        for name in file_names:
+            files.append((Path(dir_path)/name).relative_to(tree).as_posix())
+    return sorted(files)
+
+def hash_tree(tree: Path, files: typing.List[str], extra: typing.Iterable[str] = ()) -> str:
+    h = hashlib.sha256()
+    for item in extra:
+        h.update(item.encode() + b'\0')
+    for rel in files:
+        h.update(rel.encode() + b'\0')
+        h.update(hash_file(tree/rel).encode() + b'\0')
+    return h.hexdigest()
+
+def _get_digest_path(archive_path: Path) -> Path:
+    return archive_path.with_name(archive_path.name + '.json')
+
+def create_archive(tree: Path, archive_path: Path, threads: int) -> bool:
+    # Archives every file in tree. Returns False if the archive is already up to date.
+    # The hash of the input tree is stored next to the archive, so that unchanged trees are not repackaged.
+    files = _list_files(tree)
+    settings = ARCHIVE_SETTINGS + [f'-mmt={threads}']
+    digest = hash_tree(tree, files, settings)
+    digest_path = _get_digest_path(archive_path)
+    if archive_path.is_file():
+        try:
+            with digest_path.open('r') as f:
+                if json.load(f).get('sha256') == digest:
+                    return False
+        except (OSError, ValueError):
+            pass
+
+    start = time.perf_counter()
+    fd, tmp_name = tempfile.mkstemp(dir=archive_path.parent, prefix=f'.{archive_path.name}.', suffix='.tmp')
+    os.close(fd)
+    tmp_path = Path(tmp_name)
+    list_path = tmp_path.with_name(tmp_path.name + '.list')
+    try:
+        # 7z refuses to add to a file that is not an archive.
+        tmp_path.unlink()
+        list_path.write_text(''.join(rel + '\n' for rel in files))
+        subprocess.run([_7Z, 'a', *settings, '-bd', '-y', str(tmp_path.resolve()), f'@{list_path.resolve()}'],
+                       cwd=tree, stdout=subprocess.DEVNULL, check=True)
+        os.replace(tmp_path, archive_path)
+    finally:
+        for path in (tmp_path, list_path):
+            if path.exists():
+                path.unlink()
+    with digest_path.open('w') as f:
+        json.dump({'sha256': digest, 'files': len(files)}, f)
+    print(f'packaged {len(files)} files into {archive_path.name} in {time.perf_counter() - start:.3f}s')
+    return True
+
+def remove_archives(archive_dir: Path, pattern: str, keep: Path) -> None:
+    # Removes previous versions of an archive.
+    for path in archive_dir.glob(pattern):
+        if path != keep:
+            path.unlink()
+            digest_path = _get_digest_path(path)
+            if digest_path.exists():
+                digest_path.unlink()
@@ -0,0 +1,167 @@
+import contextlib
+import cProfile
+import json
+from pathlib import Path
+import re
+import sys
+import threading
+import time
+import typing
+
+from compression import open_replacement_file
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None # type: ignore
+
+def _get_cpu_time() -> float:
+    # Includes worker processes that have exited (e.g. pools that have been shut down).
+    if resource is None:
+        return time.process_time()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime + children.ru_utime + children.ru_stime
+
+def _read_high_water_mark() -> typing.Optional[int]:
+    # Peak resident set size of this process since the last _reset_high_water_mark(), in bytes.
+    # Only Linux can reset the high water mark; None elsewhere.
+    try:
+        with open('/proc/self/status', 'r') as f:
+            m = re.search(r'^VmHWM:\s+(\d+) kB$', f.read(), re.MULTILINE)
+    except OSError:
+        return None
+    return int(m.group(1)) * 1024 if m else None
+
+def _reset_high_water_mark() -> bool:
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return False
+    return True
+
+def _get_peak_rss() -> typing.Optional[int]:
+    # Peak resident set size of this process or of its largest child over the lifetime of the process, in bytes.
+    if resource is None:
+        return None
+    # ru_maxrss is in bytes on macOS and in KiB everywhere else.
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return scale * max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                       resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+class Stage:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.peak_rss: typing.Optional[int] = None
+        self.files = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._lock = threading.Lock()
+
+    def add(self, files: int = 1, bytes_in: int = 0, bytes_out: int = 0) -> None:
+        with self._lock:
+            self.files += files
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'wall_time': self.wall_time,
+            'cpu_time': self.cpu_time,
+            'peak_rss': self.peak_rss,
+            'files': self.files,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+        }
+
+# Records wall time, CPU time, peak RSS and the amount of work done by each build stage.
+# CPU time and RSS are process wide, so the figures of stages that overlap (e.g. per-target stages
+# that run concurrently) include each other's work.
+# The peak RSS of a stage is the peak of the build process while the stage was running (worker processes
+# are not included). It is measured by resetting the kernel's high water mark when a stage starts, so it is
+# only available on Linux. The peak of the whole build includes the largest worker process.
+# If cprofile_dir is set, a cProfile capture of every stage is written to <cprofile_dir>/<stage>.prof.
+# Only one capture can be active at a time: nested stages are part of the capture of the outer stage.
+class BuildProfiler:
+    def __init__(self, cprofile_dir: typing.Optional[Path] = None) -> None:
+        self.cprofile_dir = cprofile_dir
+        self.stages: typing.List[Stage] = []
+        self._start_wall_time = time.perf_counter()
+        self._start_cpu_time = _get_cpu_time()
+        self._lock = threading.Lock()
+        self._is_profiling = False
+        # Stages that are running, for attributing the high water mark to every one of them when it is reset.
+        self._active_stages: typing.List[Stage] = []
+        if cprofile_dir:
+            cprofile_dir.mkdir(parents=True, exist_ok=True)
+
+    def _update_peak_rss(self) -> None:
+        # Must be called with the lock held.
+        hwm = _read_high_water_mark()
+        if hwm is None:
+            return
+        for stage in self._active_stages:
+            stage.peak_rss = max(stage.peak_rss or 0, hwm)
+
+    def _start_stage(self, stage: Stage) -> None:
+        with self._lock:
+            self._update_peak_rss()
+            if _reset_high_water_mark():
+                self._active_stages.append(stage)
+                self._update_peak_rss()
+
+    def _end_stage(self, stage: Stage) -> None:
+        with self._lock:
+            if stage in self._active_stages:
+                self._update_peak_rss()
+                self._active_stages.remove(stage)
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> typing.Iterator[Stage]:
+        stage = Stage(name)
+        profile: typing.Optional[cProfile.Profile] = None
+        with self._lock:
+            self.stages.append(stage)
+            if self.cprofile_dir and not self._is_profiling:
+                profile = cProfile.Profile()
+                self._is_profiling = True
+        self._start_stage(stage)
+        wall_time = time.perf_counter()
+        cpu_time = _get_cpu_time()
+        if profile:
+            profile.enable()
+        try:
+            yield stage
+        finally:
+            if profile:
+                profile.disable()
+            stage.wall_time = time.perf_counter() - wall_time
+            stage.cpu_time = _get_cpu_time() - cpu_time
+            self._end_stage(stage)
+            if profile:
+                assert self.cprofile_dir
+                profile.dump_stats(str(self.cprofile_dir/(re.sub(r'[^\w.-]+', '_', name) + '.prof')))
+                with self._lock:
+                    self._is_profiling = False
+
+    def to_dict(self) -> dict:
+        return {
+            'wall_time': time.perf_counter() - self._start_wall_time,
+            'cpu_time': _get_cpu_time() - self._start_cpu_time,
+            'peak_rss': _get_peak_rss(),
+            'stages': [stage.to_dict() for stage in self.stages],
+        }
+
+    def save(self, path: Path) -> None:
+        with open_replacement_file(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    def report(self) -> None:
+        for stage in self.stages:
+            rss = f'{stage.peak_rss / (1024 * 1024):8.1f}MiB' if stage.peak_rss is not None else '        -   '
+            print(f'  {stage.wall_time:8.3f}s wall  {stage.cpu_time:8.3f}s cpu  {rss}  {stage.files:>6} files  '
+                  f'{stage.bytes_in:>11} -> {stage.bytes_out:>11} bytes  {stage.name}')
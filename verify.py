@@ -0,0 +1,314 @@
+from concurrent.futures import ProcessPoolExecutor
+import difflib
+import json
+import os
+from pathlib import Path
+import stat
+import typing
+
+import aamp
+import byml
+import evfl
+from evfl.container import Container
+
+from compression import open_replacement_file, read_decompressed_file
+from manifest import FileInfo, get_file_info, is_same_file
+
+HASH_INDEX_VERSION = 1
+
+# Build trees are compared in two steps:
+#  1. every file is hashed (the hashes are kept in an index next to the tree, so only files whose
+#     inode, mtime or size changed are rehashed); files with the same hash are skipped.
+#  2. the remaining files are decompressed and parsed in a process pool. BYML, AAMP and EVFL files are compared
+#     structurally, so that files that are serialized differently but hold the same data are not reported as changed.
+
+class FileDiff(typing.NamedTuple):
+    rel: str
+    # 'added', 'removed', 'changed' or 'equivalent' (different bytes, same parsed data)
+    status: str
+    differences: typing.List[str]
+
+def _get_index_path(tree: Path) -> Path:
+    return tree.with_name(tree.name + '.hashes.json')
+
+def load_hash_index(tree: Path) -> typing.Dict[str, FileInfo]:
+    # Returns the FileInfo of every file in tree, keyed by path relative to tree.
+    index_path = _get_index_path(tree)
+    previous: typing.Dict[str, FileInfo] = dict()
+    try:
+        with index_path.open('r') as f:
+            data = json.load(f)
+        if data.get('version') == HASH_INDEX_VERSION:
+            previous = data['files']
+    except (OSError, ValueError):
+        pass
+
+    index: typing.Dict[str, FileInfo] = dict()
+    for dir_path, dir_names, file_names in os.walk(tree):
+        for name in file_names + [name for name in dir_names if os.path.islink(os.path.join(dir_path, name))]:
+            path = Path(dir_path)/name
+            rel = path.relative_to(tree).as_posix()
+            prev = previous.get(rel)
+            # Build outputs can be hardlinks to other outputs (e.g. language packs), which can replace a file
+            # without changing its mtime.
+            st = os.lstat(path)
+            if prev and prev.get('ino') != st.st_ino:
+                prev = None
+            info = get_file_info(path, prev)
+            if not stat.S_ISLNK(st.st_mode):
+                info['ino'] = st.st_ino
+            index[rel] = info
+
+    try:
+        with open_replacement_file(index_path, 'w') as f:
+            json.dump({'version': HASH_INDEX_VERSION, 'files': index}, f)
+    except OSError:
+        # The index is only a cache (e.g. the baseline may be read-only).
+        pass
+    return index
+
+def _aamp_to_plain(plist: aamp.ParameterList) -> dict:
+    d: typing.Dict[str, typing.Any] = dict()
+    if isinstance(plist, aamp.ParameterIO):
+        d['type'] = plist.type
+        d['version'] = plist.version
+    d['objects'] = {crc32: dict(obj.params) for crc32, obj in plist.objects.items()}
+    d['lists'] = {crc32: _aamp_to_plain(child) for crc32, child in plist.lists.items()}
+    return d
+
+def _evfl_to_plain(flow: evfl.EventFlow) -> dict:
+    flowchart = flow.flowchart
+    if flowchart is None:
+        raise ValueError('only flowcharts are supported')
+
+    # Event names and order are arbitrary, so events are identified by their index and only compared
+    # by walking the entry points (see _diff_evfl). Links to other events are kept apart from the event data.
+    indices = {id(event): i for i, event in enumerate(flowchart.events)}
+    def index(event: typing.Optional[evfl.event.Event]) -> typing.Optional[int]:
+        return indices[id(event)] if event is not None else None
+    def params(container: typing.Optional[Container]) -> typing.Optional[dict]:
+        return dict(container.data) if container else None
+    def actor(a: evfl.Actor) -> str:
+        return str(a.identifier)
+
+    events: typing.List[dict] = []
+    for event in flowchart.events:
+        data = event.data
+        d: typing.Dict[str, typing.Any] = {'type': type(data).__name__}
+        links: typing.Dict[str, typing.Optional[int]] = dict()
+        if isinstance(data, evfl.ActionEvent):
+            d.update(actor=actor(data.actor.v), action=data.actor_action.v.v, params=params(data.params))
+            links['next'] = index(data.nxt.v)
+        elif isinstance(data, evfl.SwitchEvent):
+            d.update(actor=actor(data.actor.v), query=data.actor_query.v.v, params=params(data.params))
+            links.update((f'cases[{value}]', index(case.v)) for value, case in sorted(data.cases.items()))
+        elif isinstance(data, evfl.ForkEvent):
+            links.update((f'forks[{i}]', index(fork.v)) for i, fork in enumerate(data.forks))
+            links['join'] = index(data.join.v)
+        elif isinstance(data, evfl.JoinEvent):
+            links['next'] = index(data.nxt.v)
+        elif isinstance(data, evfl.SubFlowEvent):
+            d.update(flowchart=data.res_flowchart_name, entry_point=data.entry_point_name, params=params(data.params))
+            links['next'] = index(data.nxt.v)
+        d['links'] = links
+        events.append(d)
+
+    return {
+        'name': flowchart.name,
+        'actors': {actor(a): {'actions': sorted(action.v for action in a.actions),
+                              'queries': sorted(query.v for query in a.queries),
+                              'params': params(a.params)} for a in flowchart.actors},
+        'entry_points': {entry_point.name: index(entry_point.main_event.v) for entry_point in flowchart.entry_points},
+        'events': events,
+    }
+
+def parse_file(path: Path) -> typing.Tuple[str, typing.Any]:
+    # Returns the format and the parsed contents of a (possibly Yaz0 compressed) file,
+    # or ('binary', None) if the format is not supported.
+    data = read_decompressed_file(path)
+    if data[0:2] in (b'BY', b'YB'):
+        return ('byml', byml.Byml(data).parse())
+    if data[0:4] == b'AAMP':
+        return ('aamp', _aamp_to_plain(aamp.Reader(data).parse()))
+    if data[0:8] == b'BFEVFL\0\0':
+        flow = evfl.EventFlow()
+        flow.read(data)
+        return ('evfl', _evfl_to_plain(flow))
+    return ('binary', None)
+
+def _diff(a: typing.Any, b: typing.Any, path: str, differences: typing.List[str], limit: int) -> None:
+    if len(differences) >= limit:
+        return
+    if type(a) is not type(b):
+        differences.append(f'{path}: {a!r} ({type(a).__name__}) -> {b!r} ({type(b).__name__})')
+    elif isinstance(a, dict):
+        for key in sorted(a.keys() | b.keys(), key=str):
+            if key not in b:
+                differences.append(f'{path}[{key!r}]: removed')
+            elif key not in a:
+                differences.append(f'{path}[{key!r}]: added')
+            else:
+                _diff(a[key], b[key], f'{path}[{key!r}]', differences, limit)
+            if len(differences) >= limit:
+                return
+    elif isinstance(a, list):
+        for i in range(min(len(a), len(b))):
+            _diff(a[i], b[i], f'{path}[{i}]', differences, limit)
+        if len(a) != len(b):
+            differences.append(f'{path}: {len(a)} -> {len(b)} items')
+    elif a != b:
+        differences.append(f'{path}: {a!r} -> {b!r}')
+
+def _get_event_data(event: dict) -> dict:
+    return {key: value for key, value in event.items() if key != 'links'}
+
+def _get_event_key(event: dict) -> str:
+    return json.dumps(_get_event_data(event), sort_keys=True, default=str)
+
+def _describe_event(event: dict) -> str:
+    data = _get_event_data(event)
+    return ' '.join(str(data[key]) for key in ('type', 'action', 'query', 'entry_point') if key in data)
+
+def _describe_events(events: typing.List[dict]) -> str:
+    s = ', '.join(_describe_event(event) for event in events[:3])
+    return s + ', ...' if len(events) > 3 else s
+
+def _get_chain(events: typing.List[dict], index: typing.Optional[int]) -> typing.List[int]:
+    # Events from index onwards that only lead to the next one (e.g. a list of flags to reset).
+    chain: typing.List[int] = []
+    while index is not None and index not in chain and list(events[index]['links']) == ['next']:
+        chain.append(index)
+        index = events[index]['links']['next']
+    return chain
+
+def _diff_evfl(old: dict, new: dict, differences: typing.List[str], limit: int) -> None:
+    # Events are matched by walking the subgraph of each entry point in both event flows at the same time
+    # and following the same links, so a difference does not shift the events that come after it.
+    # Chains of events (events that can only lead to one other event) are aligned with difflib, so that
+    # events that were inserted into or removed from a chain are reported as such.
+    # Events that are shared by several entry points are only compared once.
+    _diff(old['name'], new['name'], "['name']", differences, limit)
+    _diff(old['actors'], new['actors'], "['actors']", differences, limit)
+    old_events: typing.List[dict] = old['events']
+    new_events: typing.List[dict] = new['events']
+    visited: typing.Set[typing.Tuple[int, int]] = set()
+
+    def diff_chains(old_chain: typing.List[int], new_chain: typing.List[int], location: str, depth: int) -> None:
+        matcher = difflib.SequenceMatcher(None, [_get_event_key(old_events[i]) for i in old_chain],
+                                          [_get_event_key(new_events[i]) for i in new_chain], autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if len(differences) >= limit:
+                return
+            pairs = list(zip(old_chain[i1:i2], new_chain[j1:j2]))
+            if tag == 'equal' or (tag == 'replace' and i2 - i1 == j2 - j1):
+                visited.update(pairs)
+                for k, (old_index, new_index) in enumerate(pairs):
+                    _diff(_get_event_data(old_events[old_index]), _get_event_data(new_events[new_index]),
+                          f'{location} event {depth + j1 + k}', differences, limit)
+                continue
+            if i2 > i1:
+                differences.append(f'{location} event {depth + j1}: removed {i2 - i1} event(s): '
+                                   f'{_describe_events([old_events[i] for i in old_chain[i1:i2]])}')
+            if j2 > j1:
+                differences.append(f'{location} event {depth + j1}: inserted {j2 - j1} event(s): '
+                                   f'{_describe_events([new_events[i] for i in new_chain[j1:j2]])}')
+
+    for entry_name in sorted(old['entry_points'].keys() | new['entry_points'].keys()):
+        if len(differences) >= limit:
+            return
+        location = f"['entry_points'][{entry_name!r}]"
+        if entry_name not in new['entry_points']:
+            differences.append(f'{location}: removed')
+            continue
+        if entry_name not in old['entry_points']:
+            differences.append(f'{location}: added')
+            continue
+        # (old event, new event, number of events from the entry point, link that was followed)
+        stack: typing.List[typing.Tuple[typing.Optional[int], typing.Optional[int], int, str]] = [
+            (old['entry_points'][entry_name], new['entry_points'][entry_name], 0, 'main event')]
+        while stack and len(differences) < limit:
+            old_index, new_index, depth, link = stack.pop()
+            path = f'{location} event {depth} ({link})'
+            if old_index is None or new_index is None:
+                if old_index is not None:
+                    differences.append(f'{path}: {_describe_event(old_events[old_index])} -> None')
+                elif new_index is not None:
+                    differences.append(f'{path}: None -> {_describe_event(new_events[new_index])}')
+                continue
+            if (old_index, new_index) in visited:
+                continue
+            visited.add((old_index, new_index))
+
+            old_chain = _get_chain(old_events, old_index)
+            new_chain = _get_chain(new_events, new_index)
+            if old_chain and new_chain:
+                diff_chains(old_chain, new_chain, location, depth)
+                stack.append((old_events[old_chain[-1]]['links']['next'], new_events[new_chain[-1]]['links']['next'],
+                              depth + len(new_chain), 'next'))
+                continue
+
+            old_event = old_events[old_index]
+            new_event = new_events[new_index]
+            _diff(_get_event_data(old_event), _get_event_data(new_event), path, differences, limit)
+            if old_event['type'] != new_event['type']:
+                continue
+            old_links: typing.Dict[str, typing.Optional[int]] = old_event['links']
+            new_links: typing.Dict[str, typing.Optional[int]] = new_event['links']
+            for name in sorted(old_links.keys() | new_links.keys(), reverse=True):
+                stack.append((old_links.get(name), new_links.get(name), depth + 1, name))
+
+def compare_files(old_path: Path, new_path: Path, limit: int = 20) -> typing.Tuple[str, typing.List[str]]:
+    # Compares two files whose bytes differ. Returns the status ('changed' or 'equivalent') and the differences.
+    if old_path.is_symlink() or new_path.is_symlink():
+        return ('changed', [f'link: {os.readlink(old_path) if old_path.is_symlink() else None!r} -> '
+                            f'{os.readlink(new_path) if new_path.is_symlink() else None!r}'])
+    old_format, old = parse_file(old_path)
+    new_format, new = parse_file(new_path)
+    if old_format != new_format:
+        return ('changed', [f'format: {old_format} -> {new_format}'])
+    if old_format == 'binary':
+        if read_decompressed_file(old_path) == read_decompressed_file(new_path):
+            return ('equivalent', [])
+        return ('changed', ['binary contents differ'])
+    differences: typing.List[str] = []
+    if old_format == 'evfl':
+        _diff_evfl(old, new, differences, limit)
+    else:
+        _diff(old, new, '', differences, limit)
+    return ('changed' if differences else 'equivalent', differences)
+
+def diff_trees(old_tree: Path, new_tree: Path, jobs: int, limit: int = 20) -> typing.List[FileDiff]:
+    # Returns the files that differ between two build trees, sorted by path.
+    old_index = load_hash_index(old_tree)
+    new_index = load_hash_index(new_tree)
+    result: typing.List[FileDiff] = []
+    result += [FileDiff(rel, 'removed', []) for rel in old_index.keys() - new_index.keys()]
+    result += [FileDiff(rel, 'added', []) for rel in new_index.keys() - old_index.keys()]
+    to_compare = sorted(rel for rel in old_index.keys() & new_index.keys() if not is_same_file(old_index[rel], new_index[rel]))
+    old_paths = [old_tree/rel for rel in to_compare]
+    new_paths = [new_tree/rel for rel in to_compare]
+    if jobs > 1 and len(to_compare) > 1:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(to_compare))) as executor:
+            comparisons = list(executor.map(compare_files, old_paths, new_paths, [limit] * len(to_compare)))
+    else:
+        comparisons = [compare_files(old_path, new_path, limit) for old_path, new_path in zip(old_paths, new_paths)]
+    for rel, (status, differences) in zip(to_compare, comparisons):
+        result.append(FileDiff(rel, status, differences))
+    num_unchanged = len(old_index.keys() & new_index.keys()) - len(to_compare)
+    print(f'compared {len(new_index)} files: {num_unchanged} unchanged, {len(to_compare)} parsed with {jobs} jobs')
+    return sorted(result)
+
+def report_diff(diffs: typing.List[FileDiff]) -> None:
+    for d in diffs:
+        print(f'  {d.status:10}  {d.rel}')
+        for difference in d.differences:
+            print(f'                {difference}')
+    counts = {status: sum(1 for d in diffs if d.status == status) for status in ('changed', 'added', 'removed', 'equivalent')}
+    print(', '.join(f'{count} {status}' for status, count in counts.items()))
+
+def save_diff(diffs: typing.List[FileDiff], path: Path) -> None:
+    # Changed and added files are the ones that need to be shipped; equivalent files can be skipped.
+    data: typing.Dict[str, typing.Any] = {status: [d.rel for d in diffs if d.status == status] for status in ('changed', 'added', 'removed', 'equivalent')}
+    data['differences'] = {d.rel: d.differences for d in diffs if d.differences}
+    with path.open('w') as f:
+        json.dump(data, f, indent=1)
@@ -0,0 +1,54 @@
+import os
+from pathlib import Path
+import time
+import typing
+
+FileState = typing.Tuple[int, int, int] # (st_mode, st_mtime_ns, st_size)
+
+# Polls a set of files and directory trees for changes.
+# Polling only needs stat calls, which is cheap for trees of this size and works on every platform
+# and filesystem (including network and FUSE mounts).
+class FileWatcher:
+    def __init__(self, paths: typing.Iterable[Path]) -> None:
+        self.paths = list(paths)
+        self._state = self._scan()
+
+    def _scan(self) -> typing.Dict[Path, FileState]:
+        state: typing.Dict[Path, FileState] = dict()
+        def add(path: Path) -> None:
+            try:
+                st = os.lstat(path)
+            except FileNotFoundError:
+                return
+            state[path] = (st.st_mode, st.st_mtime_ns, st.st_size)
+        for path in self.paths:
+            if not path.is_dir():
+                add(path)
+                continue
+            for dir_path, dir_names, file_names in os.walk(path):
+                for name in file_names + dir_names:
+                    add(Path(dir_path)/name)
+        return state
+
+    def reset(self) -> None:
+        # Changes that happen after this call are reported by the next wait().
+        self._state = self._scan()
+
+    def wait(self, interval: float = 0.2, settle_time: float = 0.1) -> typing.Set[Path]:
+        # Blocks until something has changed and returns the changed paths.
+        # Editors often save with several writes (or write then rename), so changes are only reported
+        # once the watched files have been left alone for settle_time seconds.
+        while True:
+            time.sleep(interval)
+            state = self._scan()
+            if state != self._state:
+                break
+        while True:
+            time.sleep(settle_time)
+            new_state = self._scan()
+            if new_state == state:
+                break
+            state = new_state
+        changed = set(path for path in state.keys() | self._state.keys() if state.get(path) != self._state.get(path))
+        self._state = state
+        return changed
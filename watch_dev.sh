@@ -0,0 +1,6 @@
+#!/bin/sh
+
+set -e
+
+# Rebuilds build/assets_* whenever an asset or a configuration file changes and signals botw-edit after every build.
+env PATCHER_PID=$(pgrep botw-edit) ./build.py -t all --watch --gamedata-dir ~/botw/switch-view/Pack/Bootup.pack/GameData/gamedata.ssarc